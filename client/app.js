@@ -98,6 +98,9 @@ async function buildSigningHeaders() {
     return signingHeaders
 }
 
+let sessionToken = null;
+let sessionTimeout = null;
+
 const app = {
     register: async function (name, publicKey) {
         const { data } = await axiosInstance.post('/register', { name, publicKey });
@@ -106,13 +109,33 @@ const app = {
     },
 
     postLogin: async function () {
-        return axiosInstance.post('/login', {});
+        const response = await axiosInstance.post('/login', {});
+        const { token, expiresIn } = response.data;
+
+        // the session token authenticates the next requests, it is renewed before expiring
+        sessionToken = token;
+        axiosInstance.defaults.headers.common['Authorization'] = `Bearer ${token}`;
+
+        clearTimeout(sessionTimeout);
+        sessionTimeout = setTimeout(() => app.postLogin(), expiresIn * 800);
+
+        return response;
     },
 
     getSurveys: async function() {
-        return axiosInstance.get('/surveys')
-            .then(({ data }) => data)
-            .then(({ data }) => data);
+        const surveys = [];
+        let after = null;
+
+        // following the pages until the last one
+        do {
+            const params = after ? { after } : {};
+            const { data } = await axiosInstance.get('/surveys', { params });
+
+            surveys.push(...data.data);
+            after = data.next;
+        } while (after);
+
+        return surveys;
     },
 
     postSurveys: async function(title, local, dueDate, options) {
@@ -272,9 +295,13 @@ async function onLogin() {
 
     alreadyLogged = true;
 
+    subscribe();
+}
+
+function subscribe() {
     const { _id } = storage.getItem('userData');
 
-    const source = new window.EventSource(`${baseURL}/events/${_id}`);
+    const source = new window.EventSource(`${baseURL}/events/${_id}?token=${encodeURIComponent(sessionToken)}`);
 
     source.addEventListener('new-survey', ({ data }) => {
         const d = JSON.parse(data);
@@ -287,12 +314,29 @@ async function onLogin() {
         addNotification({ type: 'Enquete encerrada', text: d.title });
     });
 
+    // many surveys closed at once
+    source.addEventListener('closed-surveys', ({ data }) => {
+        for (const d of JSON.parse(data)) {
+            addNotification({ type: 'Enquete encerrada', text: d.title });
+        }
+    });
+
+    // the server could not replay what was missed while disconnected
+    source.addEventListener('reset', () => {
+        buildSurveys();
+    });
+
     source.addEventListener('ping', ({ data }) => {
         addNotification({ type: 'Ping', text: data });
     });
 
     source.addEventListener('error', (e) => {
         console.error('event source error', e);
+
+        // the browser gives up when the server refuses the stream, e.g. with an expired token
+        if (source.readyState === EventSource.CLOSED) {
+            setTimeout(subscribe, 1000);
+        }
     });
 }
 
@@ -344,13 +388,17 @@ async function onLogin() {
                 registerForm.reset();
             })
             .then(() => {
-                switchView('survey-list');
+                // every other request is signed
+                return buildSigningHeaders();
             })
             .then(() => {
-                onLogin();
+                return app.postLogin();
             })
             .then(() => {
-                return buildSigningHeaders();
+                switchView('survey-list');
+            })
+            .then(() => {
+                onLogin();
             });
     });
 
@@ -3,41 +3,115 @@ import sys
 import json
 import time
 import uuid
-import queue
 import base64
 import datetime
 import threading
+import collections
 
 # flask
-from flask import Flask, request, Response, abort, jsonify
+from flask import Flask, request, Response, abort, jsonify, g
 from flask_cors import CORS
 
-# cryptography
-from cryptography.hazmat.primitives.serialization import load_ssh_public_key
-from cryptography.exceptions import InvalidSignature
-from cryptography.hazmat.primitives import hashes
+from functools import wraps
 
 app = Flask(__name__)
 CORS(app)
 
 @app.after_request
 def after_request(response):
-    response.headers.add('Access-Control-Allow-Headers', 'Content-type,X-Signature,X-User-ID')
+    response.headers.add('Access-Control-Allow-Headers', 'Authorization,Content-type,X-Signature,X-User-ID')
     return response
 
 import pymongo
 from pymongo import MongoClient
 
+from broker import create_broker
+from indexes import ensure_indexes
+from cache import Cache
+from signatures import Verifier, request_signature
+from sessions import SessionTokens
+from scheduler import SurveyScheduler
+from presence import create_presence
+from votes import VOTES_WRITE_BEHIND, VoteWriter
+import metrics
+from profiler import PROFILER_CONFIG, QueryProfiler
+from compression import EVENTS_COMPRESSION, COMPRESSION_MIN_SIZE, negotiate, compress, compressed
+from events import Events, EventStore
+from serializers import parse_datetime
+
 # hostname = os.getenv('HOSTNAME')
 db_uri = os.getenv('DB_URI')
-client = MongoClient(db_uri)
+# counting the round trips to mongo of each request, and profiling them when enabled
+profiler = QueryProfiler()
+
+client = MongoClient(db_uri, event_listeners=[profiler])
+
+# entries kept by each cache, and seconds cached documents may be stale (changes from other processes)
+CACHE_SIZE = int(os.getenv('CACHE_SIZE', '10000'))
+CACHE_TTL = float(os.getenv('CACHE_TTL', '30'))
+
+# seconds between checks of a tally against the votes of its survey, fixing the counts a failed update missed
+TALLY_CHECK_INTERVAL = float(os.getenv('TALLY_CHECK_INTERVAL', '60'))
+
+# seconds the same mismatch must last before the tally is rebuilt, a vote is recorded before it is counted
+TALLY_RECHECK_DELAY = float(os.getenv('TALLY_RECHECK_DELAY', '5'))
+
+# votes that close a survey
+SURVEY_VOTES = 3
+
+# requests must be signed by the client key
+VERIFY_SIGNATURES = os.getenv('VERIFY_SIGNATURES', '1') == '1'
+
+# page size of GET /surveys, by default and at most
+SURVEYS_PAGE_SIZE = 100
+SURVEYS_MAX_PAGE_SIZE = 500
+
+# fields of the surveys that GET /surveys may project
+SURVEY_FIELDS = { '_id', 'title', 'createdBy', 'local', 'dueDate', 'closed', 'options' }
+
+# seconds an idle event stream waits before sending a heartbeat comment, whose write
+# fails on a dead connection
+KEEPALIVE_INTERVAL = float(os.getenv('KEEPALIVE_INTERVAL', '15'))
+
+# seconds without events after which a stream is closed (0 keeps it open), the browser
+# reconnects right away while a half-open connection is reaped
+STREAM_IDLE_TIMEOUT = float(os.getenv('STREAM_IDLE_TIMEOUT', '300'))
+
+# `python app.py` runs with the werkzeug reloader, in a process that only watches the files and restarts
+# the one serving requests (WERKZEUG_RUN_MAIN); the background threads (scheduler, vote writer, broker and
+# presence) only run in the serving process, whatever the watcher published would reach no stream
+SERVING = __name__ != '__main__' or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
 
 #####
 class DB(object):
-    def __init__(self, db):
+    def __init__(self, db, write_behind: bool = False):
         self.client_collection = db.clients
         self.survey_collection = db.surveys
         self.votes_collection = db.votes
+        self.tally_collection = db.tallies
+
+        # documents read on every request, invalidated on writes
+        self.clients = Cache(CACHE_SIZE, CACHE_TTL)
+        self.surveys = Cache(CACHE_SIZE, CACHE_TTL)
+
+        # client names by id, names never change once registered
+        self.client_names = Cache(CACHE_SIZE)
+
+        # survey results by id, as (votes total, final, results)
+        self.results = Cache(CACHE_SIZE)
+
+        # the tallies recently checked against their votes
+        self.tally_checks = Cache(CACHE_SIZE, TALLY_CHECK_INTERVAL)
+
+        # the tallies found off their votes, as (total, votes, when it was first seen)
+        self.tally_mismatches = Cache(CACHE_SIZE)
+
+        # votes written in batches by a background thread
+        self.vote_writer = None
+
+        if write_behind:
+            self.vote_writer = VoteWriter(self)
+            self.vote_writer.start()
 
     # persists a client
     def persist_client(self, name: str, public_key: str):
@@ -50,10 +124,13 @@ class DB(object):
 
         self.client_collection.insert_one(data)
 
+        self.clients.set(data['_id'], data)
+        self.client_names.set(data['_id'], name)
+
         return data
 
     # persists a survey
-    def persist_survey(self, title: str, client_id: str, local: str, due_date: datetime, options: list[str]):
+    def persist_survey(self, title: str, client_id: str, local: str, due_date: datetime.datetime, options: list[str]):
         survey_id = str(uuid.uuid4())
 
         data = {
@@ -61,157 +138,407 @@ class DB(object):
             'title': title,
             'createdBy': client_id,
             'local': local,
-            'dueDate': datetime.datetime.fromisoformat(due_date),
+            'dueDate': due_date,
             'closed': False,
             'options': options,
         }
 
         self.survey_collection.insert_one(data)
+        self.tally_collection.insert_one(self.build_tally(data, {}))
+
+        self.surveys.set(survey_id, data)
 
         return data
 
     def close_survey(self, survey_id: str) -> bool:
         self.survey_collection.update_one({ '_id': survey_id }, { '$set': { 'closed': True }})
+        self.surveys.invalidate(survey_id)
 
         return True
 
+    # closes many surveys with a single update, returning those closed by this call
+    # (the batch id tells them apart from the ones closed meanwhile by someone else)
+    def close_surveys(self, survey_ids: list[str]) -> list[dict]:
+        batch = str(uuid.uuid4())
+
+        self.survey_collection.update_many(
+            { '_id': { '$in': survey_ids }, 'closed': False },
+            { '$set': { 'closed': True, 'closeBatch': batch }},
+        )
+
+        for survey_id in survey_ids:
+            self.surveys.invalidate(survey_id)
+
+        return list(self.survey_collection.find({ '_id': { '$in': survey_ids }, 'closeBatch': batch }, { 'closeBatch': 0 }))
+
+    # lists the open surveys due until the given date
+    def list_open_surveys(self, until: datetime.datetime):
+        return self.survey_collection.find({ 'closed': False, 'dueDate': { '$lte': until }}, { '_id': 1, 'dueDate': 1 })
+
     # tries to persists a vote, if the client didn't vote that survey
+    # (the unique index on votes rejects a second one, even from concurrent requests)
     def persist_vote(self, client_id: str, survey_id: str, option: str):
-        if self.votes_collection.count_documents({ 'client_id': client_id, 'survey_id': survey_id }) == 0:
-            self.votes_collection.insert_one({ 'client_id': client_id, 'survey_id': survey_id, 'option': str(option) })
+        vote = { 'client_id': client_id, 'survey_id': survey_id, 'option': str(option) }
+
+        # waiting for the batch with the vote to be written
+        if self.vote_writer is not None:
+            return self.vote_writer.submit(vote).result()
+
+        try:
+            self.votes_collection.insert_one(vote)
+
+        except pymongo.errors.DuplicateKeyError:
+            return False
+
+        # counting the vote on the survey tally, only once it is recorded
+        self.count_votes([vote])
+
+        return True
+
+    # counts recorded votes on the survey tallies, with one update per survey option
+    def count_votes(self, votes: list[dict]):
+        counts = collections.Counter((vote['survey_id'], vote['option']) for vote in votes)
+
+        try:
+            self.tally_collection.bulk_write([
+                pymongo.UpdateOne(
+                    { '_id': survey_id, 'counts.option': option },
+                    { '$inc': { 'total': count, 'counts.$.count': count }},
+                )
+                for (survey_id, option), count in counts.items()
+            ], ordered=False)
+
+        # the votes are recorded anyway, their tallies are checked again on the next read
+        except pymongo.errors.PyMongoError as e:
+            app.logger.error('[tally] counting {0} votes failed: {1}'.format(len(votes), str(e)))
+
+            for survey_id, _ in counts:
+                self.tally_checks.invalidate(survey_id)
+
+    # the vote counts of a survey, kept up to date by persist_vote
+    def build_tally(self, survey: dict, counts: dict) -> dict:
+        return {
+            '_id': survey['_id'],
+            'total': sum(counts.values()),
+            'counts': [{ 'option': str(option), 'count': counts.get(str(option), 0) } for option in survey['options']],
+        }
+
+    # counts the votes of a survey again, recording its tally
+    def rebuild_tally(self, survey: dict) -> dict:
+        votes = list(self.votes_collection.aggregate([
+            { '$match': { 'survey_id': survey['_id'] }},
+            { '$group': { '_id': '$option', 'count': { '$sum': 1 }}},
+        ]))
+
+        tally = self.build_tally(survey, { row['_id']: row['count'] for row in votes })
+        self.tally_collection.replace_one({ '_id': survey['_id'] }, tally, upsert=True)
+
+        return tally
+
+    # the tally of a survey, rebuilt from its votes if it was never recorded (surveys created before
+    # tallies); with `reconcile`, it is also checked every TALLY_CHECK_INTERVAL seconds against the
+    # votes (an update that failed, or went through another entry point); tallies recorded before may
+    # still hold the list of their voters, left out
+    def find_tally(self, survey: dict, reconcile: bool = True) -> dict:
+        tally = self.tally_collection.find_one({ '_id': survey['_id'] }, { 'total': 1, 'counts': 1 })
 
-            return True
+        if tally is None:
+            return self.rebuild_tally(survey)
 
-        return False
+        if reconcile and self.tally_checks.get(survey['_id']) is None:
+            tally = self.reconcile_tally(survey, tally)
 
-    # checks if the survey was voted by all clients
+        return tally
+
+    # rebuilds a tally whose total is not the number of votes; votes being counted (between their insert
+    # and their $inc) also leave it behind, so it is only rebuilt once the same mismatch is seen again
+    # TALLY_RECHECK_DELAY seconds later, otherwise the rebuilt count would get their $inc on top
+    def reconcile_tally(self, survey: dict, tally: dict) -> dict:
+        votes = self.votes_collection.count_documents({ 'survey_id': survey['_id'] })
+        mismatch = self.tally_mismatches.get(survey['_id'])
+
+        if votes == tally['total']:
+            self.tally_mismatches.invalidate(survey['_id'])
+
+        elif mismatch is None or mismatch[:2] != (tally['total'], votes):
+            # checked again on the next read
+            self.tally_mismatches.set(survey['_id'], (tally['total'], votes, time.monotonic()))
+            return tally
+
+        elif time.monotonic() - mismatch[2] < TALLY_RECHECK_DELAY:
+            return tally
+
+        else:
+            app.logger.warning('[tally][{0}] {1} votes counted of {2}, rebuilding'.format(survey['_id'], tally['total'], votes))
+            tally = self.rebuild_tally(survey)
+            self.tally_mismatches.invalidate(survey['_id'])
+
+        self.tally_checks.set(survey['_id'], True)
+
+        return tally
+
+    # the clients taking part in each survey, its creator and voters; the voters of every survey come
+    # from a single query covered by the unique index on votes
+    def find_participants(self, surveys: list[dict]) -> dict:
+        participants = { survey['_id']: { survey['createdBy'] } for survey in surveys }
+
+        for vote in self.votes_collection.find({ 'survey_id': { '$in': list(participants) }}, { '_id': 0, 'survey_id': 1, 'client_id': 1 }):
+            participants[vote['survey_id']].add(vote['client_id'])
+
+        return participants
+
+    def has_voted(self, client_id: str, survey_id: str) -> bool:
+        return self.votes_collection.find_one({ 'survey_id': survey_id, 'client_id': client_id }, { '_id': 1 }) is not None
+
+    # the names of the voters of each option; results are cached until the next vote,
+    # and for good once the survey is closed
+    def find_results(self, survey: dict) -> dict:
+        cached = self.results.get(survey['_id'])
+
+        if cached is not None and cached[1]:
+            return cached[2]
+
+        total = self.find_tally(survey)['total']
+
+        if cached is not None and cached[0] == total:
+            return cached[2]
+
+        votes = list(self.votes_collection.find({ 'survey_id': survey['_id'] }, { 'client_id': 1, 'option': 1 }))
+        names = self.find_client_names([vote['client_id'] for vote in votes])
+
+        results = {}
+
+        for vote in votes:
+            results.setdefault(vote['option'], []).append(names[vote['client_id']])
+
+        self.results.set(survey['_id'], (total, survey['closed'], results))
+
+        return results
+
+    # checks if the survey was voted by all clients; the tally is not reconciled here, it may count
+    # votes twice meanwhile, so the votes themselves confirm it (with an indexed count, stopping at the
+    # threshold), as they do when the tally is due for a check and may be missing some
     def check_survey(self, survey):
-        if self.votes_collection.count_documents({ 'survey_id': survey['_id'] }) >= 3:
-            return True
+        if self.find_tally(survey, reconcile=False)['total'] < SURVEY_VOTES and self.tally_checks.get(survey['_id']) is not None:
+            return False
 
-        return False
+        return self.votes_collection.count_documents({ 'survey_id': survey['_id'] }, limit=SURVEY_VOTES) >= SURVEY_VOTES
 
+    # cached documents are copied, callers are free to change them
     def find_client(self, client_id):
-        return self.client_collection.find_one({ '_id': client_id })
+        client = self.clients.get(client_id)
+
+        if client is None:
+            client = self.client_collection.find_one({ '_id': client_id })
+
+            if client is None:
+                return None
 
-    def list_logged_clients(self):
-        return self.client_collection.find({ 'logged': True })
+            self.clients.set(client_id, client)
+
+        return dict(client)
 
     def find_survey(self, survey_id):
-        return self.survey_collection.find_one({ '_id': survey_id })
+        survey = self.surveys.get(survey_id)
 
-    def list_surveys(self):
-        return self.survey_collection.find()
+        if survey is None:
+            survey = self.survey_collection.find_one({ '_id': survey_id }, { 'closeBatch': 0 })
 
-    def close_survey(self, survey_id: str) -> bool:
-        self.survey_collection.update_one({ '_id': survey_id }, { '$set': { 'closed': True }})
+            if survey is None:
+                return None
 
-        return True
+            self.surveys.set(survey_id, survey)
+
+        return dict(survey)
+
+    # resolves the names of many clients, with a single query for those not cached
+    def find_client_names(self, client_ids) -> dict:
+        names = {}
+
+        for client_id in set(client_ids):
+            names[client_id] = self.client_names.get(client_id)
+
+        missing = [i for i, name in names.items() if name is None]
+
+        if missing:
+            for client in self.client_collection.find({ '_id': { '$in': missing }}, { 'name': 1 }):
+                names[client['_id']] = client['name']
+                self.client_names.set(client['_id'], client['name'])
+
+        return names
+
+    # lists a page of surveys ordered by due date, after the (dueDate, _id) of the previous page,
+    # with the name of their creators
+    def list_surveys(self, filters: dict = None, fields: list[str] = None, after: tuple = None, limit: int = SURVEYS_PAGE_SIZE):
+        query = dict(filters or {})
+
+        if after:
+            due_date, survey_id = after
+            keyset = { '$or': [{ 'dueDate': { '$gt': due_date }}, { 'dueDate': due_date, '_id': { '$gt': survey_id }}]}
+            query = { '$and': [query, keyset] } if query else keyset
+
+        # the due date is always returned, it is part of the page cursor; the batch of close_surveys never is
+        projection = dict.fromkeys(fields + ['dueDate'], 1) if fields else { 'closeBatch': 0 }
+
+        surveys = list(self.survey_collection.find(query, projection).sort([('dueDate', 1), ('_id', 1)]).limit(limit))
+        names = self.find_client_names([row['createdBy'] for row in surveys if 'createdBy' in row])
+
+        for row in surveys:
+            if 'createdBy' in row:
+                row['createdBy'] = names[row['createdBy']]
+
+        return surveys
 
     # set the client as logged and active, on database
     def set_client_logged(self, _id: str, flag: bool):
         self.client_collection.update_one({ '_id': _id }, { '$set': { 'logged': flag }})
+        self.clients.invalidate(_id)
+
+    def vote_stats(self) -> dict:
+        return self.vote_writer.stats() if self.vote_writer is not None else {}
+
+    def cache_stats(self) -> dict:
+        return {
+            'clients': self.clients.stats(),
+            'surveys': self.surveys.stats(),
+            'client_names': self.client_names.stats(),
+            'results': self.results.stats(),
+            'tally_checks': self.tally_checks.stats(),
+            'tally_mismatches': self.tally_mismatches.stats(),
+        }
 
-db = DB(client.surveys)
+db = DB(client.surveys, VOTES_WRITE_BEHIND and SERVING)
+
+ensure_indexes(client.surveys)
 
 #####
-class Events():
-    queues = {}
+# persisting the broadcast events, so streams can be resumed after a restart
+event_store = EventStore(client.surveys) if os.getenv('EVENTS_PERSIST') == '1' else None
 
-    def __init__(self):
-        pass
+# the clients with an open event stream, in this process and (with PRESENCE=mongo) in the others
+presence = create_presence(client.surveys, None if SERVING else 'local')
 
-    def ensure_queue(self, client_id: str):
-        if client_id not in self.queues:
-            app.logger.debug('creating queue')
-            self.queues[client_id] = queue.Queue()
-        elif self.queues[client_id].qsize() > 0:
-            app.logger.debug('found queue, qsize: {0}'.format(self.queues[client_id].qsize()))
+events = Events(create_broker(client.surveys, None if SERVING else 'local'), presence, event_store)
 
-        return self.queues[client_id]
+#####
+# served by /metrics, along with the ones of the events
+REQUEST_SECONDS = metrics.Histogram('http_request_duration_seconds', 'Time to handle a request, until the response starts.', ('route', 'method', 'status'))
+REQUEST_MONGO_COMMANDS = metrics.Histogram('http_request_mongo_commands', 'Commands sent to mongo while handling a request.', ('route',), buckets=(0, 1, 2, 3, 5, 10, 20, 50))
+REQUEST_MONGO_SECONDS = metrics.Histogram('http_request_mongo_seconds', 'Time spent on mongo commands while handling a request.', ('route',))
+metrics.Gauge('events_open_streams', 'Event streams open in this process.', function=lambda: presence.stats()['streams'])
+metrics.Histogram('events_mailbox_depth', 'Messages waiting in the mailboxes of the clients.', buckets=(0, 1, 5, 10, 25, 50, 100), function=events.mailbox_depths)
+
+@app.before_request
+def start_request():
+    g.started = time.perf_counter()
+    profiler.start()
 
-    def put(self, client_id: str, type: str, data: str):
-        msg = f'event: {type}\ndata: {data}\n\n'
+@app.after_request
+def observe_request(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
 
-        self.ensure_queue(client_id).put(msg, block=True)
+    if 'started' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.started, route=route, method=request.method, status=response.status_code)
 
-    def get(self, client_id: str):
-        return self.ensure_queue(client_id).get()
+    profile = profiler.finish(route)
 
-    def empty(self, client_id: str):
-        return self.ensure_queue(client_id).empty()
+    if profile is not None:
+        REQUEST_MONGO_COMMANDS.observe(profile.count, route=route)
+        REQUEST_MONGO_SECONDS.observe(profile.seconds, route=route)
 
-    def task_done(self, client_id: str):
-        return self.ensure_queue(client_id).task_done()
+    return response
 
-    def publish(self, type: str, data: str):
-        for client in db.list_logged_clients():
-            app.logger.info('[events][publish][{0}]'.format(client['_id']))
-            self.put(client['_id'], type, data)
+#####
+verifier = Verifier()
+sessions = SessionTokens(os.getenv('SESSION_SECRET'))
 
-events = Events()
+# compresses the JSON responses, when the client accepts it and they are large enough
+@app.after_request
+def compress_response(response):
+    if response.direct_passthrough or response.is_streamed or response.mimetype != 'application/json':
+        return response
 
-#####
+    response.vary.add('Accept-Encoding')
 
-def verify_signature(raw_public_key, message, signature):
-    return True # fake
+    encoding = negotiate(request.accept_encodings)
 
-    # loading its public key from database
-    public_key = load_ssh_public_key(raw_public_key.encode('utf-8'))
-    decoded_signature = base64.b64decode(signature)
+    if encoding is None or 'Content-Encoding' in response.headers or response.content_length < COMPRESSION_MIN_SIZE:
+        return response
 
-    app.logger.debug('decoded_signature')
-    app.logger.debug(decoded_signature)
+    response.set_data(compress(response.get_data(), encoding))
+    response.headers['Content-Encoding'] = encoding
 
-    try:
-        # verify a signature against the public key
-        public_key.verify(signature, message, hashes.SHA256())
-        return True
+    return response
+
+# checks the X-Signature header, the signature of the client id by the client key
+def check_signature(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not VERIFY_SIGNATURES:
+            return f(*args, **kwargs)
+
+        client_id, signature = request_signature(request.headers)
 
-    # on invalid signature, we just pass
-    except InvalidSignature:
-        pass
+        if not verifier.check_request(db.find_client(client_id), client_id, signature).result():
+            app.logger.info('[signature][failure][{0}]'.format(client_id))
+            return {'message': 'invalid signature'}, 403
 
-    # on every other case, we return false
-    return False
+        return f(*args, **kwargs)
 
-# def check_signature(f):
-#     @wraps(f)
-#     def decorated_function(*args, **kwargs):
-#         client_id = request.headers.get('X-User-ID', '')
-#         signature = request.headers.get('X-Signature', '')
+    return decorated_function
 
-#         app.logger.info('payload')
-#         app.logger.info(payload)
+# checks the session token issued by /login (SessionTokens.check_request), falling back to the X-Signature header
+def check_session(f):
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if not VERIFY_SIGNATURES:
+            return f(*args, **kwargs)
 
-#         app.logger.info('signature')
-#         app.logger.info(signature)
+        authenticated = sessions.check_request(request.headers, request.args, kwargs.get('client_id'))
 
-#         if verify__signature(signature, client_id):
-#             return f(*args, **kwargs)
-#         else:
-#             return abort(403, {'error': 'invalid signature'})
+        if authenticated is None:
+            return check_signature(f)(*args, **kwargs)
 
-#     return decorated_function
+        if not authenticated:
+            app.logger.info('[session][failure][{0}]'.format(kwargs.get('client_id') or request.headers.get('X-User-ID', '')))
+            return {'message': 'invalid session'}, 403
+
+        return f(*args, **kwargs)
+
+    return decorated_function
 
 def notify_clients_new_survey(survey: dict):
     s = dict(survey)
-    s['dueDate'] = str(s['dueDate'])
     s['createdBy'] = db.find_client(s['createdBy'])['name']
 
-    events.publish('new-survey', json.dumps(s))
+    events.publish('new-survey', s)
 
     return True
 
 def notify_clients_closed_survey(survey: dict):
-    s = dict(survey)
-    s['dueDate'] = str(s['dueDate'])
-    s['createdBy'] = db.find_client(s['createdBy'])['name']
+    return notify_clients_closed_surveys([survey])
 
-    events.publish('closed-survey', json.dumps(s))
+# notifies many closed surveys at once to their participants only, resolving their creators with a single query
+def notify_clients_closed_surveys(surveys: list[dict]):
+    names = db.find_client_names([survey['createdBy'] for survey in surveys])
+    participants = db.find_participants(surveys)
+    payloads = []
+
+    for survey in surveys:
+        s = dict(survey)
+        s['createdBy'] = names[s['createdBy']]
+        payloads.append(s)
+
+    events.publish_many('closed-survey', payloads, [participants[survey['_id']] for survey in surveys])
 
     return True
 
+# closes the surveys on their due date, unless it runs on its own process (cron.py)
+scheduler = SurveyScheduler(db, notify_clients_closed_surveys)
+
+if SERVING and os.getenv('SCHEDULER', '1') == '1':
+    scheduler.start()
+
 ##########
 # ROUTES #
 ##########
@@ -230,6 +557,7 @@ def register() -> tuple[list, int]:
         abort(400, {'error': 'invalid public_key'})
 
     client_data = db.persist_client(name, public_key)
+    verifier.invalidate(client_data['_id'])
 
     app.logger.info('[register][{0}] {1}'.format(client_data['_id'], client_data['name']))
 
@@ -244,37 +572,105 @@ def ping():
 
     return {'message': data}, 200
 
+# memory held by the event queues and the caches, and the votes being written
+@app.route('/stats', methods=['GET'])
+def stats():
+    return {'data': {'events': events.stats(), 'caches': db.cache_stats(), 'votes': db.vote_stats()}}, 200
+
+# the metrics of this process, in the Prometheus text format
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.REGISTRY.render(), content_type=metrics.CONTENT_TYPE)
+
+# the settings of the query profiler, and the requests it warned about; it is enabled, or
+# configured, by posting { enabled, budget, repeatLimit } (to this process only, with PROFILER_CONFIG=1)
+@app.route('/profiler', methods=['GET', 'POST'])
+def profiler_endpoint():
+    if request.method == 'POST':
+        if not PROFILER_CONFIG:
+            return {'message': 'profiler configuration disabled'}, 403
+
+        data = request.get_json(silent=True)
+
+        if not isinstance(data, dict):
+            return {'data': 'invalid settings'}, 400
+
+        try:
+            profiler.configure(data.get('enabled'), data.get('budget'), data.get('repeatLimit'))
+
+        except ValueError as e:
+            return {'data': str(e)}, 400
+
+    return {'data': profiler.stats()}, 200
+
+# the clients with an open event stream
+@app.route('/presence', methods=['GET'])
+def presence_stats():
+    return {'data': presence.stats()}, 200
+
 @app.route('/events/<client_id>')
+@check_session
 def subscribe(client_id):
     # client_id = request.headers.get('X-User-ID', '')
     # signature = request.headers.get('X-Signature', '')
 
     app.logger.debug('client_id: {0}'.format(client_id))
 
+    # sent by the browser when reconnecting
+    last_event_id = request.headers.get('Last-Event-ID')
+
     def stream():
-        counter = 0
-        events.put(client_id, "welcome", "connected")
+        if events.connect(client_id) == 1:
+            db.set_client_logged(client_id, True)
+
+        try:
+            # replaying what was missed since the last connection
+            cursor, missed = events.resume(client_id, last_event_id)
+            events.put(client_id, "welcome", "connected")
+
+            if missed:
+                yield b''.join(missed)
+
+            idle_since = time.monotonic()
+
+            while True:
+                # sleeps until a message is published, waking up only to keep the connection alive
+                cursor, messages = events.wait(client_id, cursor, timeout=KEEPALIVE_INTERVAL)
+
+                if messages:
+                    idle_since = time.monotonic()
+                    yield b''.join(messages)
+                    continue
 
-        while True:
-            time.sleep(1)
-            queue = events.ensure_queue(client_id)
+                if STREAM_IDLE_TIMEOUT and time.monotonic() - idle_since >= STREAM_IDLE_TIMEOUT:
+                    app.logger.info('[events][{0}] idle, closing the stream'.format(client_id))
+                    return
 
-            msg = ''
-            while not queue.empty():
-                counter += 1
-                msg += 'id: {0}\n\n{1}'.format(counter, queue.get())
-                queue.task_done()
-                app.logger.debug('[events][{0}] new qsize: {1}'.format(client_id, queue.qsize()))
+                yield b': ping\n\n'
 
-            yield msg
+        # the server closes the generator when a write fails, i.e. the connection is gone
+        finally:
+            if not events.disconnect(client_id):
+                db.set_client_logged(client_id, False)
 
-    return Response(stream(), content_type='text/event-stream')
+    # proxies must not buffer the stream, or the heartbeats never reach the connection
+    headers = { 'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no' }
+    body = stream()
+
+    # every event is flushed from the compressor as soon as it is written
+    encoding = negotiate(request.accept_encodings) if EVENTS_COMPRESSION else None
+
+    if encoding is not None:
+        body = compressed(body, encoding)
+        headers.update({ 'Content-Encoding': encoding, 'Vary': 'Accept-Encoding' })
+
+    return Response(body, content_type='text/event-stream', headers=headers)
 
 # login
 @app.route('/login', methods=['POST'])
+@check_signature
 def login() -> tuple[list, int]:
     client_id = request.headers.get('X-User-ID', '')
-    signature = request.headers.get('X-Signature', '')
 
     payload = request.get_json()
 
@@ -293,22 +689,11 @@ def login() -> tuple[list, int]:
     db.set_client_logged(client_id, True)
 
     app.logger.info('[login][success][{0}]'.format(client_id))
-    return {'message': 'authorized'}, 200
-
-    # if verify_signature(client['public_key'], _id.encode('utf-8'), base64.b64decode(signature)):
-    # if verify_signature(client['public_key'], client_id.encode('utf-8'), signature):
-    #     db.set_client_logged(client_id, True)
-
-    #     app.logger.info('[login][success][{0}]'.format(client_id))
-    #     return {'message': 'authorized'}, 200
-
-    # # on invalid signature, we log it and return false
-    # else:
-    #     app.logger.info('[login][failure][{0}]'.format(client_id))
-    #     return {'message': 'invalid signature'}, 401
+    return {'message': 'authorized', 'token': sessions.issue(client_id), 'expiresIn': sessions.ttl}, 200
 
 
 @app.route('/surveys', methods=['GET', 'POST'])
+@check_session
 def survey_endpoint() -> tuple[list, int]:
     if request.method == 'GET':
         return list_surveys()
@@ -318,7 +703,6 @@ def survey_endpoint() -> tuple[list, int]:
 
 def list_surveys():
     client_id = request.headers.get('X-User-ID', '')
-    signature = request.headers.get('X-Signature', '')
 
     # finding the client on the database
     client = db.find_client(client_id)
@@ -327,23 +711,68 @@ def list_surveys():
     if not client:
         return {'message': 'client not found'}, 400
 
-    # # if verify_signature(client['public_key'], _id.encode('utf-8'), base64.b64decode(signature)):
-    # if not verify_signature(client['public_key'], client_id.encode('utf-8'), signature):
-    #     return {'message': 'unauthorized'}, 403
+    # filters
+    filters = {}
+
+    if 'closed' in request.args:
+        filters['closed'] = request.args['closed'] == 'true'
+
+    if 'createdBy' in request.args:
+        filters['createdBy'] = request.args['createdBy']
+
+    try:
+        if 'dueFrom' in request.args:
+            filters.setdefault('dueDate', {})['$gte'] = parse_datetime(request.args['dueFrom'])
+
+        if 'dueTo' in request.args:
+            filters.setdefault('dueDate', {})['$lte'] = parse_datetime(request.args['dueTo'])
+
+    except ValueError:
+        return {'data': 'invalid due date range'}, 400
+
+    # projection
+    fields = [f for f in request.args.get('fields', '').split(',') if f] or None
+
+    if fields and not SURVEY_FIELDS.issuperset(fields):
+        return {'data': 'invalid fields'}, 400
+
+    # pagination
+    try:
+        limit = min(int(request.args.get('limit', SURVEYS_PAGE_SIZE)), SURVEYS_MAX_PAGE_SIZE)
+        after = decode_cursor(request.args['after']) if 'after' in request.args else None
+
+    except ValueError:
+        return {'data': 'invalid page'}, 400
+
+    if limit < 1:
+        return {'data': 'invalid page'}, 400
+
+    surveys = db.list_surveys(filters, fields, after, limit)
 
-    surveys = []
+    # the cursor of the next page, if there may be one
+    next_cursor = encode_cursor(surveys[-1]) if len(surveys) == limit else None
 
-    for row in db.list_surveys():
-        row['createdBy'] = db.find_client(row['createdBy'])['name']
-        surveys.append(row)
+    return {'data': surveys, 'next': next_cursor}, 200
 
-    return {'data': surveys}, 200
+# opaque page cursor, the (dueDate, _id) of the last survey of a page
+def encode_cursor(survey: dict) -> str:
+    raw = json.dumps([survey['dueDate'].isoformat(), survey['_id']])
+
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple:
+    try:
+        due_date, survey_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+
+        return datetime.datetime.fromisoformat(due_date), survey_id
+
+    except (TypeError, ValueError) as e:
+        raise ValueError('invalid cursor') from e
 
 def create_survey() -> tuple[list, int]:
     payload = request.get_json()
 
     client_id = request.headers.get('X-User-ID', '')
-    # signature = request.headers.get('X-Signature', '')
 
     # finding the client on the database
     client = db.find_client(client_id)
@@ -368,6 +797,12 @@ def create_survey() -> tuple[list, int]:
     if not due_date:
         return {'data': 'invalid dueDate'}, 400
 
+    try:
+        due_date = parse_datetime(due_date)
+
+    except (TypeError, ValueError):
+        return {'data': 'invalid dueDate'}, 400
+
     if len(options) == 0:
         return {'data': 'invalid options'}, 400
 
@@ -375,14 +810,15 @@ def create_survey() -> tuple[list, int]:
 
     print('[create_survey][success][{0}]'.format(survey['_id']))
 
+    scheduler.add(survey['_id'], survey['dueDate'])
     notify_clients_new_survey(survey)
 
     return {'data': survey}, 201
 
 @app.route('/survey/<survey_id>', methods=['GET'])
+@check_session
 def consult_survey(survey_id):
     client_id = request.headers.get('X-User-ID', '')
-    signature = request.headers.get('X-Signature', '')
 
     client = db.find_client(client_id)
     survey = db.find_survey(survey_id)
@@ -395,35 +831,21 @@ def consult_survey(survey_id):
     if not survey:
         return {'data': 'survey not found'}, 400
 
-    # if not self.verify_signature(client, client_id.encode('utf-8'), signature):
-    #     print('[login][failure][{0}]'.format(_id))
-    #     return {'data': 'invalid signature'}, 400
-
     # checking if the client has voted this survey
-    voted = self.votes_collection.count_documents({ 'client_id': client_id, 'survey_id': survey_id }) > 0
-
-    if not voted:
+    if not db.has_voted(client_id, survey_id):
         return {'data': 'client vote was not registered in the survey'}, 400
 
     # populating data to return to client
-    survey['votes'] = {}
-    votes = list(self.votes_collection.find({ 'survey_id': survey_id }))
-
-    for vote in votes:
-        if not vote['option'] in survey['votes']:
-            survey['votes'][vote['option']] = []
-
-        survey['votes'][vote['option']].append(self.client_collection.find_one({ '_id': vote['client_id'] })['name'])
+    survey['votes'] = db.find_results(survey)
 
     return {'data': survey}, 200
 
 @app.route('/vote', methods=['POST'])
-# def vote_survey_option(self, _id: str, survey_id: str, option: str, signature) -> list:
+@check_session
 def vote_survey_option():
     payload = request.get_json()
 
     client_id = request.headers.get('X-User-ID', '')
-    signature = request.headers.get('X-Signature', '')
 
     survey_id = payload['surveyId']
     option = payload['chosenOption']
@@ -441,34 +863,26 @@ def vote_survey_option():
 
     # if the survey is already closed
     if survey['closed'] == True:
-        status_text = 'survey already closed'
-        # return {'status': 'survey already closed'}, 200
+        return {'status': 'survey already closed'}, 200
 
     # the option do not belongs to this survey
     if option not in survey['options']:
         return {'data': 'option not found'}, 400
 
-    # verifying the signature
-    if verify_signature(client, option.encode('utf-8'), signature):
-        # persisting vote
-        if db.persist_vote(client_id, survey_id, option):
-            status_text = 'ok'
-            print('[voted][success][{0}][{1}]'.format(client['_id'], survey['_id']))
+    # persisting vote (the request was authenticated by check_session)
+    if db.persist_vote(client_id, survey_id, option):
+        status_text = 'ok'
+        print('[voted][success][{0}][{1}]'.format(client['_id'], survey['_id']))
 
-        else:
-            status_text = 'already voted'
-            print('[voted][already][{0}][{1}]'.format(client['_id'], survey['_id']))
-
-        # if all clients voted, we notify them and close the survey
-        if db.check_survey(survey):
-            notify_clients_closed_survey(survey)
-            db.close_survey(survey['_id'])
+    else:
+        status_text = 'already voted'
+        print('[voted][already][{0}][{1}]'.format(client['_id'], survey['_id']))
 
-        return {'status': status_text}, 201
+    # if all clients voted, we close the survey and notify them (unless it was closed meanwhile)
+    if db.check_survey(survey):
+        notify_clients_closed_surveys(db.close_surveys([survey['_id']]))
 
-    else:
-        print('[voted][failure][{0}][{1}]'.format(client['_id'], survey['_id']))
-        return {'status':'invalid signature'}, 400
+    return {'status': status_text}, 201
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5001, debug=True)
@@ -0,0 +1,517 @@
+import os
+import uuid
+import asyncio
+import datetime
+
+# quart
+from quart import Quart, request, abort
+from quart_cors import cors
+
+from functools import wraps
+
+# mongo
+import pymongo
+from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+
+from indexes import ensure_indexes
+from presence import Presence
+from serializers import dumps, parse_datetime
+from signatures import Verifier, request_signature
+from sessions import SessionTokens
+
+app = Quart(__name__)
+app = cors(app, allow_origin='*')
+
+# event streams are long lived, they must not be cut by the response timeout
+app.config['RESPONSE_TIMEOUT'] = None
+
+@app.after_request
+async def after_request(response):
+    response.headers.add('Access-Control-Allow-Headers', 'Authorization,Content-type,X-Signature,X-User-ID')
+    return response
+
+# hostname = os.getenv('HOSTNAME')
+db_uri = os.getenv('DB_URI')
+client = AsyncIOMotorClient(db_uri)
+
+# seconds an idle event stream waits before sending a keep-alive comment
+KEEPALIVE_INTERVAL = float(os.getenv('KEEPALIVE_INTERVAL', '15'))
+
+# requests must be signed by the client key, as in app.py
+VERIFY_SIGNATURES = os.getenv('VERIFY_SIGNATURES', '1') == '1'
+
+#####
+class AsyncDB(object):
+    def __init__(self, db):
+        self.client_collection = db.clients
+        self.survey_collection = db.surveys
+        self.votes_collection = db.votes
+        self.tally_collection = db.tallies
+
+    # persists a client
+    async def persist_client(self, name: str, public_key: str):
+        data = {
+            '_id': str(uuid.uuid4()),
+            'name': name,
+            'public_key': public_key,
+            'logged': True,
+        }
+
+        await self.client_collection.insert_one(data)
+
+        return data
+
+    # persists a survey
+    async def persist_survey(self, title: str, client_id: str, local: str, due_date: datetime.datetime, options: list[str]):
+        survey_id = str(uuid.uuid4())
+
+        data = {
+            '_id': survey_id,
+            'title': title,
+            'createdBy': client_id,
+            'local': local,
+            'dueDate': due_date,
+            'closed': False,
+            'options': options,
+        }
+
+        await self.survey_collection.insert_one(data)
+
+        # the vote counts, as kept by app.py
+        await self.tally_collection.insert_one({
+            '_id': survey_id,
+            'total': 0,
+            'counts': [{ 'option': str(option), 'count': 0 } for option in options],
+        })
+
+        return data
+
+    # closes many surveys with a single update, returning those closed by this call
+    # (the batch id tells them apart from the ones closed meanwhile by someone else)
+    async def close_surveys(self, survey_ids: list[str]) -> list[dict]:
+        batch = str(uuid.uuid4())
+
+        await self.survey_collection.update_many(
+            { '_id': { '$in': survey_ids }, 'closed': False },
+            { '$set': { 'closed': True, 'closeBatch': batch }},
+        )
+
+        return await self.survey_collection.find({ '_id': { '$in': survey_ids }, 'closeBatch': batch }, { 'closeBatch': 0 }).to_list(None)
+
+    # tries to persists a vote, if the client didn't vote that survey
+    # (the unique index on votes rejects a second one, even from concurrent requests)
+    async def persist_vote(self, client_id: str, survey_id: str, option: str):
+        try:
+            await self.votes_collection.insert_one({ 'client_id': client_id, 'survey_id': survey_id, 'option': str(option) })
+
+        except pymongo.errors.DuplicateKeyError:
+            return False
+
+        # counting the vote on the survey tally, a failure is fixed when app.py checks the tally
+        try:
+            await self.tally_collection.update_one(
+                { '_id': survey_id, 'counts.option': str(option) },
+                { '$inc': { 'total': 1, 'counts.$.count': 1 }},
+            )
+
+        except pymongo.errors.PyMongoError as e:
+            app.logger.error('[tally][{0}] counting the vote failed: {1}'.format(survey_id, str(e)))
+
+        return True
+
+    # checks if the survey was voted by all clients
+    async def check_survey(self, survey):
+        if await self.votes_collection.count_documents({ 'survey_id': survey['_id'] }) >= 3:
+            return True
+
+        return False
+
+    async def find_client(self, client_id):
+        return await self.client_collection.find_one({ '_id': client_id })
+
+    # the names of many clients, with a single query
+    async def find_client_names(self, client_ids) -> dict:
+        names = {}
+
+        async for client in self.client_collection.find({ '_id': { '$in': list(set(client_ids)) }}, { 'name': 1 }):
+            names[client['_id']] = client['name']
+
+        return names
+
+    async def find_survey(self, survey_id):
+        return await self.survey_collection.find_one({ '_id': survey_id }, { 'closeBatch': 0 })
+
+    # without the batch set by the scheduler of app.py when closing surveys
+    def list_surveys(self):
+        return self.survey_collection.find({}, { 'closeBatch': 0 })
+
+    def list_votes(self, survey_id: str):
+        return self.votes_collection.find({ 'survey_id': survey_id }, { 'client_id': 1, 'option': 1 })
+
+    async def has_voted(self, client_id: str, survey_id: str) -> bool:
+        return await self.votes_collection.count_documents({ 'client_id': client_id, 'survey_id': survey_id }) > 0
+
+    # set the client as logged and active, on database
+    async def set_client_logged(self, _id: str, flag: bool):
+        await self.client_collection.update_one({ '_id': _id }, { '$set': { 'logged': flag }})
+
+db = AsyncDB(client.surveys)
+
+# the unique index on votes is required by persist_vote
+@app.before_serving
+async def create_indexes():
+    await asyncio.get_running_loop().run_in_executor(None, ensure_indexes, MongoClient(db_uri).surveys)
+
+#####
+class AsyncEvents():
+    def __init__(self, db=None, presence: Presence = None):
+        self.db = db
+        self.queues = {}
+
+        # the clients with an open stream, the ones published to
+        self.presence = presence or Presence()
+
+    def ensure_queue(self, client_id: str) -> asyncio.Queue:
+        if client_id not in self.queues:
+            app.logger.debug('creating queue')
+            self.queues[client_id] = asyncio.Queue()
+
+        return self.queues[client_id]
+
+    def put(self, client_id: str, type: str, data: str):
+        if not self.presence.is_local(client_id):
+            return
+
+        msg = f'event: {type}\ndata: {data}\n\n'
+
+        self.ensure_queue(client_id).put_nowait(msg)
+
+    # waits for a message, raising asyncio.TimeoutError after `timeout` seconds
+    async def get(self, client_id: str, timeout: float = None):
+        return await asyncio.wait_for(self.ensure_queue(client_id).get(), timeout)
+
+    def empty(self, client_id: str):
+        return self.ensure_queue(client_id).empty()
+
+    def get_nowait(self, client_id: str):
+        return self.ensure_queue(client_id).get_nowait()
+
+    # delivers to every open stream, without going through the database
+    async def publish(self, type: str, data: str):
+        self.broadcast(type, data)
+
+    def broadcast(self, type: str, data: str):
+        clients = self.presence.local()
+
+        for client_id in clients:
+            self.put(client_id, type, data)
+
+        app.logger.info('[events][publish] {0} x{1}'.format(type, len(clients)))
+
+    # yields the raw event stream of a client, until the connection is closed
+    async def stream(self, client_id: str):
+        counter = 0
+        self.presence.connect(client_id)
+        self.put(client_id, 'welcome', 'connected')
+
+        try:
+            while True:
+                # sleeps until a message is published, waking up only to keep the connection alive
+                try:
+                    msg = await self.get(client_id, timeout=KEEPALIVE_INTERVAL)
+
+                except asyncio.TimeoutError:
+                    yield ': keep-alive\n\n'
+                    continue
+
+                counter += 1
+                msg = 'id: {0}\n{1}'.format(counter, msg)
+
+                # draining whatever was published meanwhile, so bursts go out in one write
+                while not self.empty(client_id):
+                    counter += 1
+                    msg += 'id: {0}\n{1}'.format(counter, self.get_nowait(client_id))
+
+                yield msg
+
+        finally:
+            # the queue is shared by every stream of the client
+            if not self.presence.disconnect(client_id):
+                self.queues.pop(client_id, None)
+
+events = AsyncEvents(db)
+
+#####
+verifier = Verifier()
+
+# the same SESSION_SECRET as app.py, so a token issued by either one works on both
+sessions = SessionTokens(os.getenv('SESSION_SECRET'))
+
+# the checks of app.py, the verification runs on the thread pool of the verifier without blocking the loop
+def check_signature(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not VERIFY_SIGNATURES:
+            return await f(*args, **kwargs)
+
+        client_id, signature = request_signature(request.headers)
+
+        if not await asyncio.wrap_future(verifier.check_request(await db.find_client(client_id), client_id, signature)):
+            app.logger.info('[signature][failure][{0}]'.format(client_id))
+            return {'message': 'invalid signature'}, 403
+
+        return await f(*args, **kwargs)
+
+    return decorated_function
+
+def check_session(f):
+    @wraps(f)
+    async def decorated_function(*args, **kwargs):
+        if not VERIFY_SIGNATURES:
+            return await f(*args, **kwargs)
+
+        authenticated = sessions.check_request(request.headers, request.args, kwargs.get('client_id'))
+
+        if authenticated is None:
+            return await check_signature(f)(*args, **kwargs)
+
+        if not authenticated:
+            app.logger.info('[session][failure][{0}]'.format(kwargs.get('client_id') or request.headers.get('X-User-ID', '')))
+            return {'message': 'invalid session'}, 403
+
+        return await f(*args, **kwargs)
+
+    return decorated_function
+
+
+async def notify_clients_new_survey(survey: dict):
+    s = dict(survey)
+    s['createdBy'] = (await db.find_client(s['createdBy']))['name']
+
+    await events.publish('new-survey', dumps(s).decode('utf-8'))
+
+    return True
+
+async def notify_clients_closed_surveys(surveys: list[dict]):
+    names = await db.find_client_names([survey['createdBy'] for survey in surveys])
+
+    for survey in surveys:
+        s = dict(survey)
+        s['createdBy'] = names[s['createdBy']]
+
+        await events.publish('closed-survey', dumps(s).decode('utf-8'))
+
+    return True
+
+##########
+# ROUTES #
+##########
+
+@app.route('/register', methods=['POST'])
+async def register() -> tuple[list, int]:
+    data = await request.get_json()
+
+    name = data.get('name')
+    public_key = data.get('publicKey')
+
+    if not name:
+        abort(400, {'error': 'invalid name'})
+
+    if not public_key:
+        abort(400, {'error': 'invalid public_key'})
+
+    client_data = await db.persist_client(name, public_key)
+    verifier.invalidate(client_data['_id'])
+
+    app.logger.info('[register][{0}] {1}'.format(client_data['_id'], client_data['name']))
+
+    return client_data, 201
+
+
+# just ping
+@app.route('/ping', methods=['GET'])
+async def ping():
+    data = 'pong {0}'.format(datetime.datetime.now())
+    await events.publish('ping', data)
+
+    return {'message': data}, 200
+
+@app.route('/events/<client_id>')
+@check_session
+async def subscribe(client_id):
+    app.logger.debug('client_id: {0}'.format(client_id))
+
+    headers = {
+        'Content-Type': 'text/event-stream',
+        'Cache-Control': 'no-cache',
+    }
+
+    return events.stream(client_id), 200, headers
+
+# login
+@app.route('/login', methods=['POST'])
+@check_signature
+async def login() -> tuple[list, int]:
+    client_id = request.headers.get('X-User-ID', '')
+
+    # finding the client on the database
+    client = await db.find_client(client_id)
+
+    # if the client was not found
+    if not client:
+        return {'message': 'client not found'}, 401
+
+    await db.set_client_logged(client_id, True)
+
+    app.logger.info('[login][success][{0}]'.format(client_id))
+    return {'message': 'authorized', 'token': sessions.issue(client_id), 'expiresIn': sessions.ttl}, 200
+
+
+@app.route('/surveys', methods=['GET', 'POST'])
+@check_session
+async def survey_endpoint() -> tuple[list, int]:
+    if request.method == 'GET':
+        return await list_surveys()
+
+    elif request.method == 'POST':
+        return await create_survey()
+
+async def list_surveys():
+    client_id = request.headers.get('X-User-ID', '')
+
+    # finding the client on the database
+    client = await db.find_client(client_id)
+
+    # if the client was not found
+    if not client:
+        return {'message': 'client not found'}, 400
+
+    surveys = await db.list_surveys().to_list(None)
+    names = await db.find_client_names([row['createdBy'] for row in surveys])
+
+    for row in surveys:
+        row['createdBy'] = names[row['createdBy']]
+
+    return {'data': surveys}, 200
+
+async def create_survey() -> tuple[list, int]:
+    payload = await request.get_json()
+
+    client_id = request.headers.get('X-User-ID', '')
+
+    # finding the client on the database
+    client = await db.find_client(client_id)
+
+    # if the client was not found
+    if not client:
+        return {'message': 'client not found'}, 400
+
+    title = payload['title']
+    local = payload['local']
+    due_date = payload['dueDate']
+    options = payload['options']
+
+    if not title:
+        return {'data': 'invalid title'}, 400
+
+    if not local:
+        return {'data': 'invalid local'}, 400
+
+    if not due_date:
+        return {'data': 'invalid dueDate'}, 400
+
+    try:
+        due_date = parse_datetime(due_date)
+
+    except (TypeError, ValueError):
+        return {'data': 'invalid dueDate'}, 400
+
+    if len(options) == 0:
+        return {'data': 'invalid options'}, 400
+
+    survey = await db.persist_survey(title, client_id, local, due_date, options)
+
+    app.logger.info('[create_survey][success][{0}]'.format(survey['_id']))
+
+    await notify_clients_new_survey(survey)
+
+    return {'data': survey}, 201
+
+@app.route('/survey/<survey_id>', methods=['GET'])
+@check_session
+async def consult_survey(survey_id):
+    client_id = request.headers.get('X-User-ID', '')
+
+    client = await db.find_client(client_id)
+    survey = await db.find_survey(survey_id)
+
+    # if the client was not found
+    if not client:
+        return {'data': 'client not found'}, 400
+
+    # if the survey was not found
+    if not survey:
+        return {'data': 'survey not found'}, 400
+
+    # checking if the client has voted this survey
+    if not await db.has_voted(client_id, survey_id):
+        return {'data': 'client vote was not registered in the survey'}, 400
+
+    # populating data to return to client, with the names of every voter from a single query
+    survey['votes'] = {}
+
+    votes = await db.list_votes(survey_id).to_list(None)
+    names = await db.find_client_names([vote['client_id'] for vote in votes])
+
+    for vote in votes:
+        survey['votes'].setdefault(vote['option'], []).append(names[vote['client_id']])
+
+    return {'data': survey}, 200
+
+@app.route('/vote', methods=['POST'])
+@check_session
+async def vote_survey_option():
+    payload = await request.get_json()
+
+    client_id = request.headers.get('X-User-ID', '')
+
+    survey_id = payload['surveyId']
+    option = payload['chosenOption']
+
+    client = await db.find_client(client_id)
+    survey = await db.find_survey(survey_id)
+
+    # if the client was not found
+    if not client:
+        return {'data': 'client not found'}, 400
+
+    # if the survey was not found
+    if not survey:
+        return {'data': 'survey not found'}, 400
+
+    # if the survey is already closed
+    if survey['closed'] == True:
+        return {'status': 'survey already closed'}, 200
+
+    # the option do not belongs to this survey
+    if option not in survey['options']:
+        return {'data': 'option not found'}, 400
+
+    # persisting vote
+    if await db.persist_vote(client_id, survey_id, option):
+        status_text = 'ok'
+        app.logger.info('[voted][success][{0}][{1}]'.format(client['_id'], survey['_id']))
+
+    else:
+        status_text = 'already voted'
+        app.logger.info('[voted][already][{0}][{1}]'.format(client['_id'], survey['_id']))
+
+    # if all clients voted, we close the survey and notify them (unless it was closed meanwhile)
+    if await db.check_survey(survey):
+        await notify_clients_closed_surveys(await db.close_surveys([survey['_id']]))
+
+    return {'status': status_text}, 201
+
+if __name__ == '__main__':
+    app.run(host='0.0.0.0', port=5001)
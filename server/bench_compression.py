@@ -0,0 +1,87 @@
+"""
+Benchmark of the compression of the event streams and of the JSON responses,
+with surveys like the ones created by the browser client:
+
+    python bench_compression.py [--events 1000] [--page 100]
+
+For every content coding it reports the bytes on the wire per event and the
+CPU time to compress each one, flushing after every event as the streams do,
+and the size of a GET /surveys page compressed at once.
+"""
+import time
+import random
+import argparse
+import datetime
+
+from broker import LocalBroker
+from presence import Presence
+from events import Events
+from serializers import dumps
+from compression import ENCODINGS, StreamCompressor, compress
+
+WORDS = ['enquete', 'reunião', 'almoço', 'equipe', 'projeto', 'sala', 'sexta', 'próxima', 'semana', 'horário', 'local', 'votação']
+
+def build_survey(i: int) -> dict:
+    words = random.sample(WORDS, 4)
+
+    return {
+        '_id': '{0:08x}-1d5c-4c3e-9a57-3f2b8e6d{1:04x}'.format(random.getrandbits(32), i % 65536),
+        'title': ' '.join(words[:3]).capitalize(),
+        'createdBy': random.choice(['Ana', 'Bruno', 'Carla', 'Diego']),
+        'local': 'Sala {0}'.format(random.randint(1, 20)),
+        'dueDate': datetime.datetime.now() + datetime.timedelta(minutes=random.randint(1, 10000)),
+        'closed': False,
+        'options': [(datetime.datetime.now() + datetime.timedelta(days=d)).strftime('%Y-%m-%d %H:%M') for d in range(random.randint(2, 5))],
+    }
+
+# the frames written to a stream, as formatted by Events
+def build_frames(surveys: list[dict]) -> list[bytes]:
+    presence = Presence()
+    events = Events(LocalBroker(), presence, log_size=len(surveys))
+    presence.connect('bench')
+
+    for survey in surveys:
+        events.publish('new-survey', survey)
+
+    _, frames = events.wait('bench', 0, timeout=0)
+
+    return frames
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--events', type=int, default=1000)
+    parser.add_argument('--page', type=int, default=100, help='surveys in a GET /surveys page')
+    args = parser.parse_args()
+
+    random.seed(0)
+
+    surveys = [build_survey(i) for i in range(args.events)]
+    frames = build_frames(surveys)
+    raw = sum(len(frame) for frame in frames)
+
+    print('stream, {0} events'.format(len(frames)))
+    print('  identity: {0:8.1f} bytes/event'.format(raw / len(frames)))
+
+    for encoding in ENCODINGS:
+        compressor = StreamCompressor(encoding)
+
+        started = time.process_time()
+        sent = sum(len(compressor.compress(frame)) for frame in frames)
+        elapsed = time.process_time() - started
+
+        print('  {0:8}: {1:8.1f} bytes/event ({2:.0%}), {3:6.1f} us/event'.format(encoding, sent / len(frames), sent / raw, elapsed / len(frames) * 1e6))
+
+    page = dumps({ 'data': surveys[:args.page] })
+
+    print('GET /surveys, {0} surveys'.format(args.page))
+    print('  identity: {0:8d} bytes'.format(len(page)))
+
+    for encoding in ENCODINGS:
+        started = time.process_time()
+        sent = len(compress(page, encoding))
+        elapsed = time.process_time() - started
+
+        print('  {0:8}: {1:8d} bytes ({2:.0%}), {3:6.1f} us'.format(encoding, sent, sent / len(page), elapsed * 1e6))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+Micro-benchmark of the signature verification of the requests, with a key
+like the ones registered by the browser client (ECDSA P-521, OpenSSH format):
+
+    python bench_signatures.py [--seconds 3] [--threads 8]
+
+uncached: parses the public key on every verification
+cached:   verifies with an already parsed key
+pool:     cached keys, verifications submitted to the Verifier thread pool
+"""
+import time
+import base64
+import argparse
+import concurrent.futures
+
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, utils
+
+from signatures import Verifier, load_public_key, verify
+
+def build_client():
+    private_key = ec.generate_private_key(ec.SECP521R1())
+    public_key = private_key.public_key().public_bytes(serialization.Encoding.OpenSSH, serialization.PublicFormat.OpenSSH)
+
+    client_id = 'bench-client'
+
+    # signing like WebCrypto does, in the raw r || s format
+    r, s = utils.decode_dss_signature(private_key.sign(client_id.encode('utf-8'), ec.ECDSA(hashes.SHA256())))
+    signature = base64.b64encode(r.to_bytes(66, 'big') + s.to_bytes(66, 'big')).decode('ascii')
+
+    return { '_id': client_id, 'public_key': public_key.decode('utf-8') }, signature
+
+# runs `f` for about `seconds` seconds, returning the calls per second
+def rate(f, seconds: float) -> float:
+    calls = 0
+    started = time.perf_counter()
+
+    while time.perf_counter() - started < seconds:
+        assert f()
+        calls += 1
+
+    return calls / (time.perf_counter() - started)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--threads', type=int, default=8, help='concurrent requests in the pool run')
+    args = parser.parse_args()
+
+    client, signature = build_client()
+    message = client['_id'].encode('utf-8')
+
+    uncached = rate(lambda: verify(load_public_key(client['public_key']), message, signature), args.seconds)
+    print('uncached: {0:8.0f} verifies/s'.format(uncached))
+
+    public_key = load_public_key(client['public_key'])
+    cached = rate(lambda: verify(public_key, message, signature), args.seconds)
+    print('cached:   {0:8.0f} verifies/s ({1:.2f}x)'.format(cached, cached / uncached))
+
+    # concurrent requests, each one waiting for its verification
+    verifier = Verifier()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.threads) as requests:
+        futures = [requests.submit(rate, lambda: verifier.verify(client, message, signature), args.seconds) for _ in range(args.threads)]
+        pool = sum(f.result() for f in futures)
+
+    print('pool:     {0:8.0f} verifies/s ({1:.2f}x), {2} workers'.format(pool, pool / uncached, verifier.workers))
+
+if __name__ == '__main__':
+    main()
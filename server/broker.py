@@ -0,0 +1,171 @@
+import os
+import json
+import time
+import logging
+import itertools
+import threading
+
+import pymongo
+from pymongo import CursorType, ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+#####
+# A broker carries published events to every process serving event streams.
+# `start(deliver)` is called once per process with the callback that hands
+# events to the local subscribers, `publish(events)` may be called from any
+# process with a list of (event_id, type, data, recipients, published), whose
+# ids are taken from `next_ids(count)`, increasing across every process and
+# restart.
+
+# single process, events are delivered right away
+class LocalBroker(object):
+    def __init__(self):
+        # ids start from the current time in milliseconds, so they keep increasing after a restart
+        self.ids = itertools.count(int(time.time() * 1000))
+        self.lock = threading.Lock()
+        self.deliver = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def next_ids(self, count: int) -> list[int]:
+        with self.lock:
+            return [next(self.ids) for _ in range(count)]
+
+    def publish(self, events: list[tuple]):
+        self.deliver(events)
+
+# creates a capped collection of `size` bytes, unless it exists
+def create_capped_collection(db, name: str, size: int):
+    if name not in db.list_collection_names():
+        try:
+            db.create_collection(name, capped=True, size=size)
+
+        # another process created it first
+        except pymongo.errors.CollectionInvalid:
+            pass
+
+# events are inserted in a capped collection, that every process tails
+# (a capped collection works on a standalone mongod, change streams would need a replica set)
+class MongoBroker(object):
+    def __init__(self, db, name: str = 'events', size: int = 16 * 1024 * 1024):
+        create_capped_collection(db, name, size)
+        self.collection = db[name]
+        self.counters = db.counters
+        self.deliver = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+        threading.Thread(target=self.listen, name='mongo-broker', daemon=True).start()
+
+    def next_ids(self, count: int) -> list[int]:
+        counter = self.counters.find_one_and_update({ '_id': 'events' }, { '$inc': { 'seq': count } }, upsert=True, return_document=ReturnDocument.AFTER)
+
+        return list(range(counter['seq'] - count + 1, counter['seq'] + 1))
+
+    # a single document per batch, so the subscribers get it at once
+    def publish(self, events: list[tuple]):
+        self.collection.insert_one({ 'events': [list(event) for event in events] })
+
+    # the _id of the last document, None if the collection is empty
+    def last_id(self):
+        last = self.collection.find_one(sort=[('$natural', -1)])
+
+        return last['_id'] if last else None
+
+    def listen(self):
+        # only events published from now on are delivered
+        last_id = self.last_id()
+
+        while True:
+            try:
+                # documents are tailed in insertion order, the ObjectIds of different publishers
+                # are not ordered, so the ones up to the last delivered are skipped instead of filtered
+                if last_id is not None and self.collection.find_one({ '_id': last_id }, { '_id': 1 }) is None:
+                    logger.warning('[broker][mongo] the last delivered events were overwritten, some events are lost')
+                    last_id = self.last_id()
+
+                skipping = last_id is not None
+                cursor = self.collection.find(cursor_type=CursorType.TAILABLE_AWAIT)
+
+                while cursor.alive:
+                    for doc in cursor:
+                        if skipping:
+                            skipping = doc['_id'] != last_id
+                            continue
+
+                        last_id = doc['_id']
+                        self.deliver([tuple(event) for event in doc['events']])
+
+            except pymongo.errors.PyMongoError as e:
+                logger.warning('[broker][mongo] tailing failed: {0}'.format(str(e)))
+
+            # the cursor dies right away while the collection is empty
+            time.sleep(1)
+
+# events are sent through a redis pub/sub channel, any client exposing
+# `publish` and `pubsub` (redis.Redis, fakeredis.FakeRedis) can be used
+class RedisBroker(object):
+    def __init__(self, redis, channel: str = 'events'):
+        self.redis = redis
+        self.channel = channel
+        self.deliver = None
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+        # subscribing before returning, so nothing published afterwards is lost
+        self.subscribe()
+
+        threading.Thread(target=self.listen, name='redis-broker', daemon=True).start()
+
+    def subscribe(self):
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        self.pubsub.subscribe(self.channel)
+
+    def next_ids(self, count: int) -> list[int]:
+        last = self.redis.incrby('{0}:id'.format(self.channel), count)
+
+        return list(range(last - count + 1, last + 1))
+
+    def publish(self, events: list[tuple]):
+        self.redis.publish(self.channel, json.dumps(events))
+
+    def listen(self):
+        while True:
+            try:
+                for message in self.pubsub.listen():
+                    self.deliver([tuple(event) for event in json.loads(message['data'])])
+
+            # e.g. the connection was lost, what was published meanwhile is lost too
+            except Exception as e:
+                logger.warning('[broker][redis] listening failed: {0}'.format(str(e)))
+
+            time.sleep(1)
+
+            try:
+                self.pubsub.close()
+                self.subscribe()
+
+            except Exception as e:
+                logger.warning('[broker][redis] subscribing failed: {0}'.format(str(e)))
+
+# builds the broker configured by EVENTS_BROKER (local, mongo or redis)
+def create_broker(db, kind: str = None):
+    kind = kind or os.getenv('EVENTS_BROKER', 'local')
+
+    if kind == 'local':
+        return LocalBroker()
+
+    if kind == 'mongo':
+        return MongoBroker(db)
+
+    if kind == 'redis':
+        # optional dependency, only needed by this broker
+        import redis
+
+        return RedisBroker(redis.Redis.from_url(os.getenv('REDIS_URL', 'redis://localhost:6379/0')))
+
+    raise ValueError('unknown events broker: {0}'.format(kind))
@@ -0,0 +1,59 @@
+import os
+import zlib
+
+# compresses the event streams of the clients accepting it, off by default
+EVENTS_COMPRESSION = os.getenv('EVENTS_COMPRESSION', '0') == '1'
+
+# JSON responses smaller than this are sent uncompressed, it would not pay off
+COMPRESSION_MIN_SIZE = int(os.getenv('COMPRESSION_MIN_SIZE', '1024'))
+
+COMPRESSION_LEVEL = int(os.getenv('COMPRESSION_LEVEL', '6'))
+
+# the window (2^bits bytes) and memory level of the stream compressors, every open stream
+# holds one: 12 and 5 take about 32 KB each, instead of the 256 KB of zlib defaults, while
+# events of a few hundred bytes still compress against the previous ones
+STREAM_WINDOW_BITS = int(os.getenv('STREAM_WINDOW_BITS', '12'))
+STREAM_MEMORY_LEVEL = int(os.getenv('STREAM_MEMORY_LEVEL', '5'))
+
+# zlib wbits of each content coding: gzip framing, or the zlib framing of HTTP "deflate"
+ENCODINGS = {
+    'gzip': 16,
+    'deflate': 0,
+}
+
+# the content coding to use, from the Accept-Encoding of the request (werkzeug MIMEAccept), None if none fits
+def negotiate(accept_encodings) -> str:
+    return accept_encodings.best_match(list(ENCODINGS))
+
+def compress(data: bytes, encoding: str, level: int = COMPRESSION_LEVEL) -> bytes:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding] + zlib.MAX_WBITS)
+
+    return compressor.compress(data) + compressor.flush()
+
+#####
+# Compression of a long lived stream, every chunk is flushed on its own
+# (Z_SYNC_FLUSH), so the client decompresses each event as soon as it arrives,
+# while the dictionary built from the previous events is kept.
+class StreamCompressor(object):
+    def __init__(self, encoding: str, level: int = COMPRESSION_LEVEL, window_bits: int = STREAM_WINDOW_BITS, memory_level: int = STREAM_MEMORY_LEVEL):
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, ENCODINGS[encoding] + window_bits, memory_level)
+
+    def compress(self, chunk: bytes) -> bytes:
+        return self.compressor.compress(chunk) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self.compressor.flush()
+
+# compresses the chunks of a stream generator, closing it along with the returned one
+def compressed(chunks, encoding: str):
+    compressor = StreamCompressor(encoding)
+
+    try:
+        for chunk in chunks:
+            yield compressor.compress(chunk)
+
+        # the stream ended on its own, e.g. it was idle
+        yield compressor.finish()
+
+    finally:
+        chunks.close()
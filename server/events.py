@@ -0,0 +1,464 @@
+import os
+import time
+import logging
+import itertools
+import threading
+import collections
+
+from broker import create_capped_collection
+from serializers import dumps
+from metrics import EVENTS_PUBLISH_SECONDS, EVENTS_FANOUT_SECONDS, EVENTS_DELIVERY_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# number of broadcast events kept for subscribers that are behind
+LOG_SIZE = int(os.getenv('EVENTS_LOG_SIZE', '1024'))
+
+# messages kept for a single client, and what to do when its mailbox is full
+MAILBOX_SIZE = int(os.getenv('MAILBOX_SIZE', '100'))
+MAILBOX_POLICIES = ('drop-oldest', 'drop-newest', 'coalesce')
+MAILBOX_POLICY = os.getenv('MAILBOX_POLICY', 'drop-oldest')
+
+# checked on import, a mailbox is only created by the first stream
+if MAILBOX_POLICY not in MAILBOX_POLICIES:
+    raise ValueError('unknown mailbox policy: {0}'.format(MAILBOX_POLICY))
+
+# seconds a mailbox is kept without being read
+MAILBOX_TTL = float(os.getenv('MAILBOX_TTL', '600'))
+
+# consecutive events of these types are sent to a stream in a single frame, as a list
+COALESCED_EVENTS = {
+    'closed-survey': 'closed-surveys',
+}
+
+# a broadcast event in the log, `seq` is its position in this process, `data` its encoded payload,
+# `frame` its encoded message, `recipients` the ids of the clients it is sent to (every client, if None)
+# and `published` the time it was published (None if it was reloaded from the store);
+# payloads and frames are encoded once, and written as they are to every stream
+LogEntry = collections.namedtuple('LogEntry', ['seq', 'id', 'type', 'data', 'frame', 'recipients', 'published'])
+
+def visible(entry: LogEntry, client_id: str) -> bool:
+    return entry.recipients is None or client_id in entry.recipients
+
+# the frames of a run of log entries, coalescing consecutive events of the COALESCED_EVENTS types
+def frames(entries) -> list[bytes]:
+    result = []
+    run = []
+
+    def flush():
+        if len(run) == 1:
+            result.append(run[0].frame)
+
+        elif run:
+            data = b','.join(entry.data for entry in run)
+            result.append(b'id: %d\nevent: %s\ndata: [%s]\n\n' % (run[-1].id, COALESCED_EVENTS[run[0].type].encode('utf-8'), data))
+
+        run.clear()
+
+    for entry in entries:
+        if run and entry.type != run[0].type:
+            flush()
+
+        if entry.type in COALESCED_EVENTS:
+            run.append(entry)
+
+        else:
+            result.append(entry.frame)
+
+    flush()
+
+    return result
+
+# tells the client to reload its state, the events it missed are gone; it resumes after `last_id` from then on
+def reset_frame(last_id: int) -> bytes:
+    return b'id: %d\nevent: reset\ndata: %d\n\n' % (last_id, last_id)
+
+#####
+# Bounded queue of messages to a single client. When full, the `drop-oldest`
+# policy discards the oldest message, `drop-newest` discards the incoming one
+# and `coalesce` replaces a pending message of the same type (falling back to
+# drop-oldest).
+class Mailbox():
+    def __init__(self, size: int = MAILBOX_SIZE, policy: str = MAILBOX_POLICY):
+        if policy not in MAILBOX_POLICIES:
+            raise ValueError('unknown mailbox policy: {0}'.format(policy))
+
+        self.messages = collections.deque()
+        self.size = size
+        self.policy = policy
+        self.bytes = 0
+        self.touched = time.monotonic()
+
+    def __len__(self):
+        return len(self.messages)
+
+    def touch(self):
+        self.touched = time.monotonic()
+
+    def remove(self, index: int):
+        type, msg, size = self.messages[index]
+        del self.messages[index]
+        self.bytes -= size
+
+    # appends a message, returning how many were dropped to fit it
+    def append(self, type: str, msg: bytes) -> int:
+        dropped = 0
+
+        if self.policy == 'coalesce':
+            for i, (pending_type, _, _) in enumerate(self.messages):
+                if pending_type == type:
+                    self.remove(i)
+                    dropped += 1
+                    break
+
+        if len(self.messages) >= self.size:
+            if self.policy == 'drop-newest':
+                return dropped + 1
+
+            self.remove(0)
+            dropped += 1
+
+        size = len(msg)
+        self.messages.append((type, msg, size))
+        self.bytes += size
+
+        return dropped
+
+    def popleft(self) -> bytes:
+        type, msg, size = self.messages.popleft()
+        self.bytes -= size
+
+        return msg
+
+#####
+# Optional persistence of the broadcast events, in a capped collection, so the
+# log survives restarts.
+class EventStore():
+    def __init__(self, db, name: str = 'event_log', size: int = 16 * 1024 * 1024):
+        create_capped_collection(db, name, size)
+        self.collection = db[name]
+
+    # appends (event_id, type, data, recipients, published) events
+    def append(self, events: list[tuple]):
+        self.collection.insert_many([
+            { '_id': event_id, 'type': type, 'data': data, 'recipients': recipients }
+            for event_id, type, data, recipients, _ in events
+        ])
+
+    # the last `limit` events, oldest first
+    def load(self, limit: int) -> list[dict]:
+        return list(self.collection.find().sort('_id', -1).limit(limit))[::-1]
+
+#####
+# Broadcast events are formatted once and appended to a shared ring buffer,
+# every open stream keeps a cursor (the position of the last event it sent in
+# this process) and reads the log from there. Event ids are allocated by the
+# broker and are the same in every process, so a reconnecting browser can
+# resume from its Last-Event-ID. Events may be addressed to some clients only,
+# the streams of other clients skip them and are not even woken up (nor reset
+# when those events leave the log before they read it). Messages to
+# a single client (e.g. welcome) go to its own mailbox instead, mailboxes not
+# read for `mailbox_ttl` seconds are evicted. Only clients with an open stream
+# (as told by the presence registry) get messages.
+class Events():
+    def __init__(self, broker, presence, store: EventStore = None, log_size: int = LOG_SIZE, mailbox_ttl: float = MAILBOX_TTL):
+        self.queues = {}
+        self.log = collections.deque(maxlen=log_size)
+        self.last_seq = 0
+        self.store = store
+
+        # the seq of the last entry pushed out of the log that was for every client, and of the last one
+        # for each client with a stream here; a stream behind the log only lost events it could see
+        self.evicted_seq = 0
+        self.evicted_seqs = {}
+
+        self.mailbox_ttl = mailbox_ttl
+        self.last_sweep = time.monotonic()
+        self.dropped = 0
+        self.evicted = 0
+
+        # the streams of a client wait on its own condition, so only the recipients of an event are woken up
+        self.lock = threading.RLock()
+        self.waiters = {}
+        self.waiting = collections.Counter()
+
+        self.presence = presence
+
+        # reloading the events persisted before a restart
+        if self.store is not None:
+            self.deliver([(event['_id'], event['type'], event['data'], event.get('recipients'), None) for event in self.store.load(log_size)])
+
+        self.broker = broker
+        self.broker.start(self.deliver)
+
+    def ensure_queue(self, client_id: str):
+        if client_id not in self.queues:
+            logger.debug('creating queue')
+            self.queues[client_id] = Mailbox()
+
+        return self.queues[client_id]
+
+    # sends a message to a single client, if it has a stream open here
+    def put(self, client_id: str, type: str, data: str):
+        if not self.presence.is_local(client_id):
+            return
+
+        msg = f'event: {type}\ndata: {data}\n\n'.encode('utf-8')
+
+        with self.lock:
+            self.dropped += self.ensure_queue(client_id).append(type, msg)
+            self.wake([client_id])
+
+            # evicting idle mailboxes from time to time
+            if time.monotonic() - self.last_sweep > self.mailbox_ttl / 10:
+                self.evict()
+
+    # registers a new stream of the client, returning how many it has open here
+    def connect(self, client_id: str) -> int:
+        return self.presence.connect(client_id)
+
+    # unregisters a closed stream of the client, returning how many are still open here;
+    # once the last one is gone, its mailbox goes too
+    def disconnect(self, client_id: str) -> int:
+        count = self.presence.disconnect(client_id)
+
+        if count:
+            return count
+
+        with self.lock:
+            # unless it reconnected meanwhile
+            if not self.presence.is_local(client_id):
+                self.queues.pop(client_id, None)
+                self.evicted_seqs.pop(client_id, None)
+
+        logger.info('[events][{0}] disconnected'.format(client_id))
+
+        return 0
+
+    # removes the mailboxes not read for `mailbox_ttl` seconds, returning how many
+    def evict(self) -> int:
+        with self.lock:
+            now = time.monotonic()
+            expired = [k for k, mailbox in self.queues.items() if now - mailbox.touched > self.mailbox_ttl]
+
+            for client_id in expired:
+                del self.queues[client_id]
+
+            self.last_sweep = now
+            self.evicted += len(expired)
+
+        if expired:
+            logger.info('[events][evict] {0} idle mailboxes'.format(len(expired)))
+
+        return len(expired)
+
+    # wakes the streams of the given clients up, or every stream if None (the lock must be held)
+    def wake(self, client_ids=None):
+        if client_ids is None:
+            waiters = list(self.waiters.values())
+
+        else:
+            waiters = [self.waiters[client_id] for client_id in client_ids if client_id in self.waiters]
+
+        for waiter in waiters:
+            waiter.notify_all()
+
+    # counters of what is held in memory
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'queues': len(self.queues),
+                'messages': sum(len(mailbox) for mailbox in self.queues.values()),
+                'bytes': sum(mailbox.bytes for mailbox in self.queues.values()),
+                'dropped': self.dropped,
+                'evicted': self.evicted,
+                'streams_waiting': sum(self.waiting.values()),
+                'log_events': len(self.log),
+                'log_bytes': sum(len(entry.frame) for entry in self.log),
+            }
+
+    # sends the event to every process, through the broker, for the given clients only (every client, if None);
+    # the data is sent as it is if it is a string, otherwise encoded as JSON
+    def publish(self, type: str, data, recipients: list[str] = None):
+        self.publish_many(type, [data], [recipients])
+
+    # sends many events of the same type at once, with a single broker message;
+    # `recipients` holds the clients of each event, if they are not for every client
+    def publish_many(self, type: str, items: list, recipients: list = None):
+        if not items:
+            return
+
+        items = [data if isinstance(data, str) else dumps(data).decode('utf-8') for data in items]
+
+        recipients = recipients or [None] * len(items)
+
+        # targeted events go to the clients online only, and are not sent at all when none is
+        if any(clients is not None for clients in recipients):
+            online = self.presence.online()
+            recipients = [set(clients) & online if clients is not None else None for clients in recipients]
+            kept = [i for i, clients in enumerate(recipients) if clients is None or clients]
+            items, recipients = [items[i] for i in kept], [recipients[i] for i in kept]
+
+            if not items:
+                return
+
+        started = time.time()
+
+        events = [
+            (event_id, type, data, sorted(clients) if clients is not None else None, started)
+            for event_id, data, clients in zip(self.broker.next_ids(len(items)), items, recipients)
+        ]
+
+        if self.store is not None:
+            self.store.append(events)
+
+        self.broker.publish(events)
+
+        EVENTS_PUBLISH_SECONDS.observe(time.time() - started)
+
+    # called by the broker, in every process, to append (event_id, type, data, recipients, published) events to the log
+    def deliver(self, events: list[tuple]):
+        if not events:
+            return
+
+        started = time.perf_counter()
+        woken = set()
+
+        with self.lock:
+            for event_id, type, data, recipients, published in events:
+                if recipients is not None:
+                    recipients = frozenset(recipients)
+
+                data = data.encode('utf-8')
+                frame = b'id: %d\nevent: %s\ndata: %s\n\n' % (event_id, type.encode('utf-8'), data)
+
+                if self.log and len(self.log) == self.log.maxlen:
+                    self.forget(self.log[0])
+
+                self.last_seq += 1
+                self.log.append(LogEntry(self.last_seq, event_id, type, data, frame, recipients, published))
+
+                if woken is not None:
+                    woken = woken | recipients if recipients is not None else None
+
+            self.wake(woken)
+
+        EVENTS_FANOUT_SECONDS.observe(time.perf_counter() - started)
+
+        logger.info('[events][publish][{0}] {1} x{2}'.format(events[-1][0], events[-1][1], len(events)))
+
+    # records the visibility of an entry about to be pushed out of the log (the lock must be held)
+    def forget(self, entry: LogEntry):
+        if entry.recipients is None:
+            self.evicted_seq = entry.seq
+            return
+
+        for client_id in entry.recipients:
+            if self.presence.is_local(client_id):
+                self.evicted_seqs[client_id] = entry.seq
+
+    # the cursor of a new stream, with the events it missed since `last_event_id`; when
+    # they are no longer in the log, the client is told to reset its state instead
+    def resume(self, client_id: str, last_event_id: str = None) -> tuple[int, list[bytes]]:
+        with self.lock:
+            if not last_event_id:
+                return self.last_seq, []
+
+            try:
+                last_event_id = int(last_event_id)
+
+            except ValueError:
+                last_event_id = None
+
+            if not self.log or last_event_id is None or not self.log[0].id - 1 <= last_event_id <= self.log[-1].id:
+                logger.info('[events][{0}] cannot resume from {1}, resetting'.format(client_id, last_event_id))
+                return self.last_seq, [reset_frame(self.last_id())]
+
+            messages = frames(entry for entry in self.log if entry.id > last_event_id and visible(entry, client_id))
+
+            logger.info('[events][{0}] resumed from {1}, {2} events replayed'.format(client_id, last_event_id, len(messages)))
+
+            return self.last_seq, messages
+
+    # the id of the last broadcast event
+    def last_id(self) -> int:
+        return self.log[-1].id if self.log else 0
+
+    # the number of messages waiting in each mailbox
+    def mailbox_depths(self) -> list[int]:
+        with self.lock:
+            return [len(mailbox) for mailbox in self.queues.values()]
+
+    # the messages to the client after the cursor, with the new cursor (the lock must be held)
+    def collect(self, client_id: str, cursor: int) -> tuple[int, list[bytes]]:
+        messages = []
+
+        # direct messages
+        mailbox = self.queues.get(client_id)
+
+        if mailbox is not None:
+            mailbox.touch()
+
+            while mailbox:
+                messages.append(mailbox.popleft())
+
+        # broadcast events after the cursor, skipping those addressed to other clients
+        if cursor < self.last_seq:
+            first_seq = self.log[0].seq
+
+            # what it missed is no longer in the log, it reloads its state instead, unless
+            # none of it was for the client (its streams are not woken up by those events)
+            if cursor + 1 < first_seq:
+                if max(self.evicted_seq, self.evicted_seqs.get(client_id, 0)) > cursor:
+                    logger.warning('[events][{0}] lagged behind, {1} events lost, resetting'.format(client_id, first_seq - cursor - 1))
+                    messages.append(reset_frame(self.last_id()))
+
+                    return self.last_seq, messages
+
+                cursor = first_seq - 1
+
+            entries = [entry for entry in itertools.islice(self.log, cursor + 1 - first_seq, None) if visible(entry, client_id)]
+            messages.extend(frames(entries))
+
+            now = time.time()
+
+            for entry in entries:
+                if entry.published is not None:
+                    EVENTS_DELIVERY_SECONDS.observe(now - entry.published)
+
+            cursor = self.last_seq
+
+        return cursor, messages
+
+    # waits up to `timeout` seconds for messages to the client, returning them with the new cursor
+    def wait(self, client_id: str, cursor: int, timeout: float = None) -> tuple[int, list[bytes]]:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+
+        with self.lock:
+            while True:
+                cursor, messages = self.collect(client_id, cursor)
+
+                if messages:
+                    return cursor, messages
+
+                remaining = deadline - time.monotonic() if deadline is not None else None
+
+                if remaining is not None and remaining <= 0:
+                    return cursor, []
+
+                if client_id not in self.waiters:
+                    self.waiters[client_id] = threading.Condition(self.lock)
+
+                waiter = self.waiters[client_id]
+                self.waiting[client_id] += 1
+
+                try:
+                    waiter.wait(remaining)
+
+                finally:
+                    self.waiting[client_id] -= 1
+
+                    # the last stream of the client is gone
+                    if not self.waiting[client_id]:
+                        del self.waiting[client_id]
+                        del self.waiters[client_id]
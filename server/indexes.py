@@ -0,0 +1,145 @@
+"""
+Index management of the surveys database.
+
+    python indexes.py           creates the missing indexes
+    python indexes.py explain   explains every query issued by the DB class,
+                                failing if any of them scans a whole collection
+    python indexes.py dedupe    removes the duplicated votes recorded before the
+                                unique index existed, then creates the indexes
+"""
+import os
+import sys
+import logging
+import datetime
+
+import pymongo
+from pymongo import ASCENDING, MongoClient
+
+logger = logging.getLogger(__name__)
+
+# indexes of each collection, as (keys, options)
+INDEXES = {
+    'surveys': [
+        # paging through the surveys by due date, optionally filtered
+        ([('dueDate', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('closed', ASCENDING), ('dueDate', ASCENDING), ('_id', ASCENDING)], {}),
+        ([('createdBy', ASCENDING), ('dueDate', ASCENDING), ('_id', ASCENDING)], {}),
+    ],
+    'presence': [
+        # dropping the reports of processes that stopped refreshing them
+        ([('expiresAt', ASCENDING)], { 'expireAfterSeconds': 0 }),
+    ],
+    'votes': [
+        # a single vote per client in a survey, also serves the lookups by survey
+        ([('survey_id', ASCENDING), ('client_id', ASCENDING)], { 'unique': True }),
+    ],
+}
+
+# every query issued by the DB class, as (description, collection, filter, sort)
+QUERIES = [
+    ('find client', 'clients', { '_id': 'id' }, None),
+    ('find client names', 'clients', { '_id': { '$in': ['id'] }}, None),
+    ('find survey', 'surveys', { '_id': 'id' }, None),
+    ('list surveys', 'surveys', {}, [('dueDate', 1), ('_id', 1)]),
+    ('list surveys by state', 'surveys', { 'closed': False }, [('dueDate', 1), ('_id', 1)]),
+    ('list surveys by creator', 'surveys', { 'createdBy': 'id' }, [('dueDate', 1), ('_id', 1)]),
+    ('list due surveys', 'surveys', { 'closed': False, 'dueDate': { '$lte': datetime.datetime.now() }}, None),
+    ('list closed batch', 'surveys', { '_id': { '$in': ['id'] }, 'closeBatch': 'id' }, None),
+    ('find vote', 'votes', { 'client_id': 'id', 'survey_id': 'id' }, None),
+    ('list survey votes', 'votes', { 'survey_id': 'id' }, None),
+    ('list participants votes', 'votes', { 'survey_id': { '$in': ['id'] }}, None),
+    ('list online clients', 'presence', { 'expiresAt': { '$gt': datetime.datetime.now() }}, None),
+    ('find tally', 'tallies', { '_id': 'id' }, None),
+]
+
+# creates the missing indexes, existing ones are left untouched; unique indexes
+# are required (they are the only guard against duplicates), so failing to
+# create one raises, while the others are only logged
+def ensure_indexes(db):
+    for name, indexes in INDEXES.items():
+        for keys, options in indexes:
+            try:
+                db[name].create_index(keys, **options)
+
+            # e.g. duplicated votes recorded before the unique index existed
+            except pymongo.errors.OperationFailure as e:
+                logger.error('[indexes][{0}] could not create {1}: {2}'.format(name, keys, str(e)))
+
+                if options.get('unique'):
+                    raise RuntimeError('the unique index {0} of {1} is missing, run `python indexes.py dedupe` if there are duplicates'.format(keys, name)) from e
+
+# keeps the first vote of each client in a survey, removing the others, returning how many;
+# the tallies of those surveys are removed too, and rebuilt from the votes when read
+def remove_duplicate_votes(db) -> int:
+    duplicates = db.votes.aggregate([
+        { '$sort': { '_id': 1 }},
+        { '$group': { '_id': { 'survey_id': '$survey_id', 'client_id': '$client_id' }, 'ids': { '$push': '$_id' }, 'count': { '$sum': 1 }}},
+        { '$match': { 'count': { '$gt': 1 }}},
+    ], allowDiskUse=True)
+
+    removed = 0
+    surveys = set()
+
+    for duplicate in duplicates:
+        removed += db.votes.delete_many({ '_id': { '$in': duplicate['ids'][1:] }}).deleted_count
+        surveys.add(duplicate['_id']['survey_id'])
+
+    if surveys:
+        db.tallies.delete_many({ '_id': { '$in': list(surveys) }})
+
+    logger.info('[indexes] {0} duplicated votes removed, from {1} surveys'.format(removed, len(surveys)))
+
+    return removed
+
+# the stages of the winning plan of a query
+def plan_stages(plan: dict) -> list[str]:
+    stages = []
+
+    for key, value in plan.items():
+        if key == 'stage':
+            stages.append(value)
+
+        elif isinstance(value, dict):
+            stages.extend(plan_stages(value))
+
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, dict):
+                    stages.extend(plan_stages(item))
+
+    return stages
+
+# explains every query, returning the ones scanning a whole collection
+def explain_queries(db) -> list[str]:
+    collscans = []
+
+    for description, collection, query, sort in QUERIES:
+        command = { 'find': collection, 'filter': query }
+
+        if sort:
+            command['sort'] = dict(sort)
+
+        explained = db.command('explain', command, verbosity='queryPlanner')
+        stages = plan_stages(explained['queryPlanner']['winningPlan'])
+
+        print('{0:<25} {1}'.format(description, ' <- '.join(stages)))
+
+        if 'COLLSCAN' in stages:
+            collscans.append(description)
+
+    return collscans
+
+if __name__ == '__main__':
+    db = MongoClient(os.getenv('DB_URI')).surveys
+
+    if sys.argv[1:] == ['dedupe']:
+        print('duplicated votes removed: {0}'.format(remove_duplicate_votes(db)))
+
+    ensure_indexes(db)
+
+    if sys.argv[1:] == ['explain']:
+        collscans = explain_queries(db)
+
+        if collscans:
+            print('collection scans: {0}'.format(', '.join(collscans)))
+            sys.exit(1)
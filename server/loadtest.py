@@ -0,0 +1,212 @@
+"""
+Opens N EventSource-style connections against the events endpoint and reports
+the server memory held per connection and the fan-out latency of /ping.
+
+Without --url, a local stand-in serving /events/<client_id> and /ping on top of
+the asyncio events of asgi.py is started in a subprocess, so no database is
+needed:
+
+    python loadtest.py -n 10000 --rounds 5
+
+Against a running server (pass its pid to get the memory figures), started
+with VERIFY_SIGNATURES=0 since the random client ids have no session token:
+
+    python loadtest.py -n 2000 --url http://localhost:5001 --pid 1234
+"""
+import sys
+import time
+import uuid
+import asyncio
+import argparse
+import resource
+import statistics
+import subprocess
+from urllib.parse import urlparse
+
+#####
+# stand-in server
+
+async def serve(port: int):
+    from asgi import AsyncEvents
+
+    events = AsyncEvents()
+
+    async def handle(reader, writer):
+        try:
+            request_line = await reader.readline()
+
+            # skipping the request headers
+            while (await reader.readline()).strip():
+                pass
+
+            method, path, _ = request_line.decode('ascii').split(' ', 2)
+
+            if path.startswith('/events/'):
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n\r\n')
+
+                async for msg in events.stream(path[len('/events/'):]):
+                    writer.write(msg.encode('utf-8'))
+                    await writer.drain()
+
+            elif path == '/ping':
+                events.broadcast('ping', 'pong {0}'.format(time.time()))
+                writer.write(b'HTTP/1.1 200 OK\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+
+            else:
+                writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+                await writer.drain()
+
+        except (ConnectionError, ValueError):
+            pass
+
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, '127.0.0.1', port, backlog=4096)
+
+    print('ready', flush=True)
+
+    async with server:
+        await server.serve_forever()
+
+#####
+# load generator
+
+def rss_kb(pid: int) -> int:
+    with open('/proc/{0}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+    return 0
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    return hard
+
+class Subscriber():
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.client_id = str(uuid.uuid4())
+        self.waiter = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+
+        request = 'GET /events/{0} HTTP/1.1\r\nHost: {1}\r\nAccept: text/event-stream\r\n\r\n'.format(self.client_id, self.host)
+        self.writer.write(request.encode('ascii'))
+        await self.writer.drain()
+
+        # waiting for the response headers
+        while (await self.reader.readline()).strip():
+            pass
+
+    async def listen(self):
+        while True:
+            line = await self.reader.readline()
+
+            if not line:
+                return
+
+            if line.startswith(b'event: ping') and self.waiter and not self.waiter.done():
+                self.waiter.set_result(time.perf_counter())
+
+async def ping(host: str, port: int):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('GET /ping HTTP/1.1\r\nHost: {0}\r\nConnection: close\r\n\r\n'.format(host).encode('ascii'))
+    await writer.drain()
+    await reader.read()
+    writer.close()
+
+def percentile(values: list, p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+async def run(host: str, port: int, n: int, rounds: int, pid: int = None):
+    rss_before = rss_kb(pid) if pid else None
+
+    subscribers = [Subscriber(host, port) for _ in range(n)]
+
+    started = time.perf_counter()
+
+    # connecting in batches, so the listen backlog is not overflown
+    for i in range(0, n, 500):
+        await asyncio.gather(*[s.connect() for s in subscribers[i:i + 500]])
+
+    print('connections: {0} in {1:.2f}s'.format(n, time.perf_counter() - started))
+
+    listeners = [asyncio.ensure_future(s.listen()) for s in subscribers]
+
+    # letting the welcome messages settle
+    await asyncio.sleep(1)
+
+    if pid:
+        rss_after = rss_kb(pid)
+        print('server rss: {0:.1f} MB -> {1:.1f} MB, {2:.2f} KB per connection'.format(
+            rss_before / 1024, rss_after / 1024, (rss_after - rss_before) / n))
+
+    for r in range(rounds):
+        loop = asyncio.get_running_loop()
+
+        for s in subscribers:
+            s.waiter = loop.create_future()
+
+        sent = time.perf_counter()
+        await ping(host, port)
+        arrivals = await asyncio.gather(*[s.waiter for s in subscribers])
+
+        latencies = [(a - sent) * 1000 for a in arrivals]
+
+        print('round {0}: fan-out p50 {1:.1f} ms, p99 {2:.1f} ms, max {3:.1f} ms, mean {4:.1f} ms'.format(
+            r + 1, percentile(latencies, 0.5), percentile(latencies, 0.99), max(latencies), statistics.mean(latencies)))
+
+    for listener in listeners:
+        listener.cancel()
+
+    for s in subscribers:
+        s.writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-n', '--connections', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--url', help='server to test, a local stand-in is started if omitted')
+    parser.add_argument('--pid', type=int, help='pid of the server under test, to report its memory')
+    parser.add_argument('--port', type=int, default=5099, help='port of the local stand-in')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    limit = raise_fd_limit()
+
+    if args.serve:
+        asyncio.run(serve(args.port))
+        return
+
+    if limit < args.connections + 100:
+        print('warning: open files limit is {0}, connections may fail'.format(limit))
+
+    stand_in = None
+
+    if args.url:
+        url = urlparse(args.url)
+        host, port, pid = url.hostname, url.port or 80, args.pid
+
+    else:
+        stand_in = subprocess.Popen([sys.executable, __file__, '--serve', '--port', str(args.port)], stdout=subprocess.PIPE)
+        stand_in.stdout.readline()
+        host, port, pid = '127.0.0.1', args.port, stand_in.pid
+
+    try:
+        asyncio.run(run(host, port, args.connections, args.rounds, pid))
+
+    finally:
+        if stand_in:
+            stand_in.terminate()
+            stand_in.wait()
+
+if __name__ == '__main__':
+    main()
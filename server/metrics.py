@@ -0,0 +1,151 @@
+import math
+import threading
+
+# served by /metrics
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a fast cache hit to a slow request
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+
+    return '{' + ','.join('{0}="{1}"'.format(name, value) for name, value in zip(labels, escaped)) + '}'
+
+#####
+# The metrics of the process, rendered in the Prometheus text format.
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+        return metric
+
+    def render(self) -> str:
+        lines = []
+
+        for metric in self.metrics:
+            lines.append('# HELP {0} {1}'.format(metric.name, metric.help))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.type))
+
+            for name, labels, value in metric.samples():
+                lines.append('{0}{1} {2}'.format(name, format_labels(labels), format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+#####
+# A value per combination of labels, passed as keyword arguments. A `function`
+# makes the metric read its (unlabelled) value when it is collected instead.
+class Counter(object):
+    type = 'counter'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None, registry: Registry = REGISTRY):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+        registry.register(self)
+
+    def key(self, labels: dict) -> tuple:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[tuple]:
+        if self.function is not None:
+            return [(self.name, {}, self.function())]
+
+        with self.lock:
+            return [(self.name, dict(zip(self.label_names, key)), value) for key, value in self.values.items()]
+
+class Gauge(Counter):
+    type = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+# the observations are counted in cumulative buckets, a `function` returns every value to count when collected
+class Histogram(Counter):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS, function=None, registry: Registry = REGISTRY):
+        self.buckets = tuple(buckets) + (math.inf,)
+
+        super().__init__(name, help, labels, function, registry)
+
+    def empty(self) -> list:
+        # the count of each bucket, then the sum
+        return [0] * len(self.buckets) + [0]
+
+    def add(self, counts: list, value: float):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+
+        counts[-1] += value
+
+    def observe(self, value: float, **labels):
+        key = self.key(labels)
+
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = self.empty()
+
+            self.add(self.values[key], value)
+
+    def samples(self) -> list[tuple]:
+        if self.function is not None:
+            counts = self.empty()
+
+            for value in self.function():
+                self.add(counts, value)
+
+            series = [((), counts)]
+
+        else:
+            with self.lock:
+                series = [(key, list(counts)) for key, counts in self.values.items()]
+
+        samples = []
+
+        for key, counts in series:
+            labels = dict(zip(self.label_names, key))
+            cumulative = 0
+
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append((self.name + '_bucket', dict(labels, le=format_value(bound)), cumulative))
+
+            samples.append((self.name + '_sum', labels, counts[-1]))
+            samples.append((self.name + '_count', labels, cumulative))
+
+        return samples
+
+#####
+# metrics of the events, shared by every Events instance of the process
+
+EVENTS_PUBLISH_SECONDS = Histogram('events_publish_seconds', 'Time to hand a batch of events to the broker.')
+EVENTS_FANOUT_SECONDS = Histogram('events_fanout_seconds', 'Time to append a delivered batch to the log and wake its streams up.')
+EVENTS_DELIVERY_SECONDS = Histogram('events_delivery_seconds', 'Time from the publication of an event to its collection by a stream.')
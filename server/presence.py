@@ -0,0 +1,155 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import datetime
+import threading
+import collections
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+# seconds between the reports of a process to the shared presence, which expire after PRESENCE_TTL
+PRESENCE_INTERVAL = float(os.getenv('PRESENCE_INTERVAL', '10'))
+PRESENCE_TTL = float(os.getenv('PRESENCE_TTL', '30'))
+
+#####
+# The clients of every process, one document per process in the `presence`
+# collection. A client is added when its first stream opens in the process and
+# removed when the last one closes; the document is refreshed every
+# PRESENCE_INTERVAL seconds and ignored once it is not refreshed for
+# PRESENCE_TTL seconds (a process that died), then removed by a TTL index.
+class MongoPresence(object):
+    def __init__(self, db, process_id: str, ttl: float = PRESENCE_TTL):
+        self.collection = db.presence
+        self.process_id = process_id
+        self.ttl = ttl
+
+    def expires_at(self) -> datetime.datetime:
+        return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=self.ttl)
+
+    def add(self, client_id: str):
+        self.collection.update_one({ '_id': self.process_id }, { '$addToSet': { 'clients': client_id }, '$set': { 'expiresAt': self.expires_at() }}, upsert=True)
+
+    def remove(self, client_id: str):
+        self.collection.update_one({ '_id': self.process_id }, { '$pull': { 'clients': client_id }})
+
+    # rewrites the clients of this process, fixing whatever a failed update missed
+    def report(self, client_ids: list[str]):
+        self.collection.replace_one({ '_id': self.process_id }, { 'clients': client_ids, 'expiresAt': self.expires_at() }, upsert=True)
+
+    # the clients with an open stream in any live process, and how many processes there are
+    def online(self) -> tuple[set, int]:
+        clients = set()
+        processes = 0
+
+        for doc in self.collection.find({ 'expiresAt': { '$gt': datetime.datetime.now(datetime.timezone.utc) }}, { 'clients': 1 }):
+            clients.update(doc.get('clients', []))
+            processes += 1
+
+        return clients, processes
+
+#####
+# Registry of the clients with an open event stream, updated as streams connect
+# and disconnect. On its own it only knows this process; with a shared `store`
+# (MongoPresence) it also answers for every other process.
+class Presence(object):
+    def __init__(self, store=None, interval: float = PRESENCE_INTERVAL):
+        self.streams = collections.Counter()
+        self.lock = threading.Lock()
+        self.store = store
+        self.interval = interval
+
+        if self.store is not None:
+            threading.Thread(target=self.run, name='presence', daemon=True).start()
+
+    # registers a new stream of the client, returning how many it has open here
+    def connect(self, client_id: str) -> int:
+        with self.lock:
+            self.streams[client_id] += 1
+            count = self.streams[client_id]
+
+        if count == 1:
+            self.update(self.store.add if self.store else None, client_id)
+
+        return count
+
+    # unregisters a closed stream of the client, returning how many are still open here
+    def disconnect(self, client_id: str) -> int:
+        with self.lock:
+            self.streams[client_id] -= 1
+            count = self.streams[client_id]
+
+            if count <= 0:
+                del self.streams[client_id]
+
+        if count <= 0:
+            self.update(self.store.remove if self.store else None, client_id)
+
+        return max(count, 0)
+
+    # the store is not essential, a failure is fixed by the next report
+    def update(self, f, client_id: str):
+        if f is None:
+            return
+
+        try:
+            f(client_id)
+
+        except pymongo.errors.PyMongoError as e:
+            logger.warning('[presence] update failed: {0}'.format(str(e)))
+
+    def is_local(self, client_id: str) -> bool:
+        return client_id in self.streams
+
+    def local(self) -> set:
+        with self.lock:
+            return set(self.streams)
+
+    # the clients online in any process
+    def online(self) -> set:
+        if self.store is None:
+            return self.local()
+
+        return self.store.online()[0] | self.local()
+
+    def stats(self) -> dict:
+        with self.lock:
+            stats = {
+                'clients': len(self.streams),
+                'streams': sum(self.streams.values()),
+            }
+
+        if self.store is not None:
+            clients, processes = self.store.online()
+            stats.update({ 'process': self.store.process_id, 'online': len(clients | self.local()), 'processes': processes })
+
+        return stats
+
+    # refreshes the report of this process
+    def run(self):
+        while True:
+            try:
+                self.store.report(sorted(self.local()))
+
+            except pymongo.errors.PyMongoError as e:
+                logger.warning('[presence] report failed: {0}'.format(str(e)))
+
+            time.sleep(self.interval)
+
+# builds the presence configured by PRESENCE (local or mongo); processes sharing
+# events through a broker share their presence through mongo by default
+def create_presence(db, kind: str = None) -> Presence:
+    kind = kind or os.getenv('PRESENCE', 'local' if os.getenv('EVENTS_BROKER', 'local') == 'local' else 'mongo')
+
+    if kind == 'local':
+        return Presence()
+
+    if kind == 'mongo':
+        process_id = '{0}:{1}:{2}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+        return Presence(MongoPresence(db, process_id))
+
+    raise ValueError('unknown presence: {0}'.format(kind))
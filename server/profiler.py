@@ -0,0 +1,153 @@
+import os
+import json
+import logging
+import threading
+import collections
+
+from flask import g, has_request_context
+from pymongo import monitoring
+
+logger = logging.getLogger(__name__)
+
+# profiles the queries of each request from the start, it can also be enabled at runtime (POST /profiler)
+MONGO_PROFILER = os.getenv('MONGO_PROFILER', '0') == '1'
+
+# commands a request may send before a warning, and times it may repeat the same query shape (N+1 queries)
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', '10'))
+QUERY_REPEAT_LIMIT = int(os.getenv('QUERY_REPEAT_LIMIT', '3'))
+
+# POST /profiler has no authentication, it only changes the settings when this is set
+PROFILER_CONFIG = os.getenv('PROFILER_CONFIG', '0') == '1'
+
+# commands of the driver itself, not issued by the application
+IGNORED_COMMANDS = { 'endSessions', 'isMaster', 'hello', 'ping' }
+
+# the values of a filter replaced by '?', so queries differing only by their values have the same shape
+def shape(value):
+    if isinstance(value, dict):
+        return { key: shape(item) for key, item in value.items() }
+
+    if isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+        return [shape(item) for item in value]
+
+    return '?'
+
+# the shape of a command, e.g. find surveys {"_id": "?"}
+def query_shape(command_name: str, command: dict) -> str:
+    collection = command.get('collection') if command_name == 'getMore' else command.get(command_name)
+    query = command.get('filter', command.get('q', command.get('query', {})))
+
+    if command_name in ('update', 'delete'):
+        statements = command.get('updates', command.get('deletes', []))
+        query = statements[0].get('q', {}) if statements else {}
+
+    elif command_name == 'aggregate':
+        query = command.get('pipeline', [])
+
+    return '{0} {1} {2}'.format(command_name, collection, json.dumps(shape(query), sort_keys=True, default=str))
+
+# the commands of a single request
+class RequestProfile(object):
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0
+        self.shapes = collections.Counter()
+
+#####
+# Listens to the commands sent to mongo and tags them with the Flask request
+# that issued them (commands sent outside a request are not counted). Every
+# request gets its count and duration; once enabled, the shapes of its queries
+# are also recorded, warning about requests going over `budget` commands or
+# repeating the same shape more than `repeat_limit` times.
+class QueryProfiler(monitoring.CommandListener):
+    def __init__(self, enabled: bool = MONGO_PROFILER, budget: int = QUERY_BUDGET, repeat_limit: int = QUERY_REPEAT_LIMIT):
+        self.enabled = enabled
+        self.budget = budget
+        self.repeat_limit = repeat_limit
+
+        self.lock = threading.Lock()
+        self.over_budget = collections.Counter()
+        self.repeated = collections.Counter()
+
+    def profile(self) -> RequestProfile:
+        return g.get('mongo_profile') if has_request_context() else None
+
+    # starts profiling the current request
+    def start(self):
+        g.mongo_profile = RequestProfile()
+
+    # stops profiling the current request, returning its profile (None if it was not started)
+    def finish(self, route: str) -> RequestProfile:
+        profile = g.pop('mongo_profile', None)
+
+        if profile is None or not self.enabled:
+            return profile
+
+        if profile.count > self.budget:
+            logger.warning('[profiler][{0}] {1} queries ({2:.1f} ms), over the budget of {3}'.format(route, profile.count, profile.seconds * 1000, self.budget))
+
+            with self.lock:
+                self.over_budget[route] += 1
+
+        for query, count in profile.shapes.items():
+            if count > self.repeat_limit:
+                logger.warning('[profiler][{0}] {1} repeated {2} times'.format(route, query, count))
+
+                with self.lock:
+                    self.repeated['{0} {1}'.format(route, query)] += 1
+
+        return profile
+
+    # changes the given settings, raising ValueError (and changing none) if any is invalid
+    def configure(self, enabled: bool = None, budget: int = None, repeat_limit: int = None):
+        if enabled is not None and not isinstance(enabled, bool):
+            raise ValueError('invalid enabled')
+
+        # bool is a subclass of int, true is not a budget
+        for name, value in (('budget', budget), ('repeatLimit', repeat_limit)):
+            if value is not None and (isinstance(value, bool) or not isinstance(value, int) or value < 0):
+                raise ValueError('invalid {0}'.format(name))
+
+        if enabled is not None:
+            self.enabled = enabled
+
+        if budget is not None:
+            self.budget = budget
+
+        if repeat_limit is not None:
+            self.repeat_limit = repeat_limit
+
+        logger.info('[profiler] enabled: {0}, budget: {1}, repeat limit: {2}'.format(self.enabled, self.budget, self.repeat_limit))
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                'enabled': self.enabled,
+                'budget': self.budget,
+                'repeat_limit': self.repeat_limit,
+                'over_budget': dict(self.over_budget),
+                'repeated': dict(self.repeated),
+            }
+
+    def started(self, event):
+        if event.command_name in IGNORED_COMMANDS:
+            return
+
+        profile = self.profile()
+
+        if profile is None:
+            return
+
+        profile.count += 1
+
+        if self.enabled:
+            profile.shapes[query_shape(event.command_name, event.command)] += 1
+
+    def succeeded(self, event):
+        profile = self.profile()
+
+        if profile is not None and event.command_name not in IGNORED_COMMANDS:
+            profile.seconds += event.duration_micros / 1e6
+
+    def failed(self, event):
+        self.succeeded(event)
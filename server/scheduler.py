@@ -0,0 +1,94 @@
+import os
+import time
+import heapq
+import logging
+import datetime
+import threading
+
+logger = logging.getLogger(__name__)
+
+# seconds between reloads of the upcoming deadlines, to pick up surveys created by other processes
+SCHEDULER_RESYNC = float(os.getenv('SCHEDULER_RESYNC', '15'))
+
+#####
+# Closes the surveys when they are due. Open surveys are kept in a min-heap by
+# due date, and the scheduler sleeps until the earliest deadline (or until a
+# survey is added), closing every due survey at once and handing them to
+# `on_close`.
+class SurveyScheduler(object):
+    def __init__(self, db, on_close, resync: float = SCHEDULER_RESYNC):
+        self.db = db
+        self.on_close = on_close
+        self.resync = resync
+
+        self.heap = []
+        self.scheduled = set()
+        self.condition = threading.Condition()
+
+    def add(self, survey_id: str, due_date: datetime.datetime):
+        with self.condition:
+            if survey_id in self.scheduled:
+                return
+
+            heapq.heappush(self.heap, (due_date, survey_id))
+            self.scheduled.add(survey_id)
+
+            # the new survey may be due before the one being waited for
+            self.condition.notify()
+
+    # loads the open surveys due before the next reload, including overdue ones
+    def sync(self):
+        until = datetime.datetime.now() + datetime.timedelta(seconds=self.resync)
+
+        for survey in self.db.list_open_surveys(until):
+            self.add(survey['_id'], survey['dueDate'])
+
+    # waits for the next deadline, for at most `timeout` seconds, returning the ids of the due surveys
+    def wait(self, timeout: float) -> list[str]:
+        with self.condition:
+            if self.heap:
+                timeout = min(timeout, (self.heap[0][0] - datetime.datetime.now()).total_seconds())
+
+            if timeout > 0:
+                self.condition.wait(timeout)
+
+            due = []
+            now = datetime.datetime.now()
+
+            while self.heap and self.heap[0][0] <= now:
+                _, survey_id = heapq.heappop(self.heap)
+                self.scheduled.discard(survey_id)
+                due.append(survey_id)
+
+        return due
+
+    def run(self):
+        logger.info('[scheduler] starting')
+
+        next_sync = datetime.datetime.now()
+
+        while True:
+            try:
+                if datetime.datetime.now() >= next_sync:
+                    self.sync()
+                    next_sync = datetime.datetime.now() + datetime.timedelta(seconds=self.resync)
+
+                due = self.wait((next_sync - datetime.datetime.now()).total_seconds())
+
+                if not due:
+                    continue
+
+                # surveys already closed by a vote or another process are left out
+                surveys = self.db.close_surveys(due)
+
+                logger.info('[scheduler] {0} surveys due, {1} closed'.format(len(due), len(surveys)))
+
+                if surveys:
+                    self.on_close(surveys)
+
+            except Exception:
+                logger.exception('[scheduler] failed')
+                time.sleep(1)
+
+    def start(self):
+        threading.Thread(target=self.run, name='scheduler', daemon=True).start()
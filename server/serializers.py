@@ -0,0 +1,38 @@
+import os
+import json
+import datetime
+
+# encoder of the event payloads, orjson when it is installed
+JSON_ENCODER = os.getenv('JSON_ENCODER', 'orjson')
+
+def default(obj):
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+
+    raise TypeError('{0} is not JSON serializable'.format(type(obj).__name__))
+
+# parses a date sent by a client; dates are stored naive, in local time, as datetime.now()
+# compares them, so a date with an UTC offset is converted (mixing both would raise TypeError)
+def parse_datetime(value: str) -> datetime.datetime:
+    parsed = datetime.datetime.fromisoformat(value)
+
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+
+    return parsed
+
+def json_dumps(obj) -> bytes:
+    return json.dumps(obj, default=default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+# encodes an object to JSON as UTF-8 bytes, datetimes in ISO 8601 (as orjson does)
+dumps = json_dumps
+
+if JSON_ENCODER == 'orjson':
+    try:
+        import orjson
+
+        dumps = orjson.dumps
+
+    # optional dependency, the standard library is used without it
+    except ImportError:
+        pass
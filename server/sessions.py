@@ -0,0 +1,81 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import logging
+import secrets
+
+logger = logging.getLogger(__name__)
+
+# seconds a session token is valid, clients log in again before that
+SESSION_TTL = int(os.getenv('SESSION_TTL', '900'))
+
+def b64encode(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+def b64decode(raw: str) -> bytes:
+    return base64.urlsafe_b64decode(raw + '=' * (-len(raw) % 4))
+
+# the session token of a request, from the Authorization header or, for EventSource, the query string
+def request_token(headers, args) -> str:
+    authorization = headers.get('Authorization', '')
+
+    if authorization.startswith('Bearer '):
+        return authorization[len('Bearer '):]
+
+    return args.get('token', '')
+
+#####
+# Short lived tokens issued on login, `<client id>.<expiration>` signed with a
+# HMAC, so later requests are authenticated without a database lookup nor an
+# asymmetric verification. Every process must share the same secret
+# (SESSION_SECRET), otherwise tokens only work on the process that issued them.
+class SessionTokens(object):
+    def __init__(self, secret: str = None, ttl: int = SESSION_TTL):
+        if not secret:
+            logger.warning('[sessions] SESSION_SECRET not set, using a random secret for this process')
+            secret = secrets.token_hex(32)
+
+        self.secret = secret.encode('utf-8')
+        self.ttl = ttl
+
+    def sign(self, payload: bytes) -> bytes:
+        return hmac.new(self.secret, payload, hashlib.sha256).digest()
+
+    def issue(self, client_id: str) -> str:
+        payload = '{0}.{1}'.format(client_id, int(time.time()) + self.ttl).encode('utf-8')
+
+        return '{0}.{1}'.format(b64encode(payload), b64encode(self.sign(payload)))
+
+    # the client id of a valid token, None if it is invalid or expired
+    def verify(self, token: str):
+        try:
+            encoded_payload, encoded_mac = token.split('.')
+            payload = b64decode(encoded_payload)
+            mac = b64decode(encoded_mac)
+
+        except ValueError:
+            return None
+
+        if not hmac.compare_digest(mac, self.sign(payload)):
+            return None
+
+        client_id, _, expires_at = payload.decode('utf-8').rpartition('.')
+
+        if int(expires_at) < time.time():
+            return None
+
+        return client_id
+
+    # checks the token of a request (headers and query arguments of any framework), which must belong
+    # to its client: the X-User-ID header, or `route_client_id` for the routes taking it; None when it
+    # has no token and its X-Signature header is checked instead, except on those routes (event
+    # streams cannot send signature headers, they always need a token)
+    def check_request(self, headers, args, route_client_id: str = None):
+        token = request_token(headers, args)
+
+        if not token and route_client_id is None:
+            return None
+
+        return self.verify(token) == (route_client_id or headers.get('X-User-ID', ''))
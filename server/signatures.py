@@ -0,0 +1,121 @@
+import os
+import base64
+import binascii
+import concurrent.futures
+
+# cryptography
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec, ed448, ed25519, padding, rsa, utils
+from cryptography.hazmat.primitives.serialization import load_pem_public_key, load_ssh_public_key
+
+from cache import Cache
+
+# threads verifying signatures, the crypto work releases the GIL
+SIGNATURE_WORKERS = int(os.getenv('SIGNATURE_WORKERS', str(os.cpu_count() or 1)))
+
+# parses a public key, in OpenSSH (as registered by the browser client) or PEM format
+def load_public_key(raw_public_key: str):
+    raw = raw_public_key.strip().encode('utf-8')
+
+    if raw.startswith(b'-----BEGIN'):
+        return load_pem_public_key(raw)
+
+    return load_ssh_public_key(raw)
+
+# the client id and the signature of a signed request, from its headers
+def request_signature(headers) -> tuple[str, str]:
+    return headers.get('X-User-ID', ''), headers.get('X-Signature', '')
+
+# verifies a base64 signature of the message, as sent in the X-Signature header
+def verify(public_key, message: bytes, signature: str) -> bool:
+    try:
+        decoded_signature = base64.b64decode(signature, validate=True)
+
+    except (binascii.Error, ValueError):
+        return False
+
+    try:
+        if isinstance(public_key, ec.EllipticCurvePublicKey):
+            # WebCrypto signs in the raw r || s format, while cryptography expects DER
+            size = (public_key.curve.key_size + 7) // 8
+
+            if len(decoded_signature) == 2 * size:
+                r = int.from_bytes(decoded_signature[:size], 'big')
+                s = int.from_bytes(decoded_signature[size:], 'big')
+                decoded_signature = utils.encode_dss_signature(r, s)
+
+            public_key.verify(decoded_signature, message, ec.ECDSA(hashes.SHA256()))
+
+        elif isinstance(public_key, rsa.RSAPublicKey):
+            public_key.verify(decoded_signature, message, padding.PKCS1v15(), hashes.SHA256())
+
+        # EdDSA hashes the message itself
+        elif isinstance(public_key, (ed25519.Ed25519PublicKey, ed448.Ed448PublicKey)):
+            public_key.verify(decoded_signature, message)
+
+        # e.g. DSA keys, which the clients do not use
+        else:
+            return False
+
+        return True
+
+    # on invalid signature, we just pass
+    except InvalidSignature:
+        pass
+
+    # on every other case, we return false
+    return False
+
+#####
+# Verifies the signatures of the clients, keeping their parsed public keys
+# and running the verification on a thread pool.
+class Verifier(object):
+    def __init__(self, workers: int = SIGNATURE_WORKERS, cache_size: int = 10000):
+        self.keys = Cache(cache_size)
+        self.workers = workers
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verifier')
+
+    # the parsed public key of a client, parsed again if the registered key changed
+    def public_key(self, client: dict):
+        cached = self.keys.get(client['_id'])
+
+        if cached is not None and cached[0] == client['public_key']:
+            return cached[1]
+
+        public_key = load_public_key(client['public_key'])
+        self.keys.set(client['_id'], (client['public_key'], public_key))
+
+        return public_key
+
+    # forgets the key of a client, e.g. when it registers again
+    def invalidate(self, client_id: str):
+        self.keys.invalidate(client_id)
+
+    # starts verifying a signature, returning a future of the result
+    def submit(self, client: dict, message: bytes, signature: str) -> concurrent.futures.Future:
+        try:
+            public_key = self.public_key(client)
+
+        # keys that could not be parsed, e.g. registered with an unsupported algorithm
+        except (TypeError, ValueError, UnsupportedAlgorithm):
+            future = concurrent.futures.Future()
+            future.set_result(False)
+
+            return future
+
+        return self.executor.submit(verify, public_key, message, signature)
+
+    def verify(self, client: dict, message: bytes, signature: str) -> bool:
+        return self.submit(client, message, signature).result()
+
+    # starts checking the signature of a request, the id of `client` signed by its key; unknown
+    # clients (None) pass, they are reported by the route itself
+    def check_request(self, client: dict, client_id: str, signature: str) -> concurrent.futures.Future:
+        if client is None:
+            future = concurrent.futures.Future()
+            future.set_result(True)
+
+            return future
+
+        return self.submit(client, client_id.encode('utf-8'), signature)
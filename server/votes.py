@@ -0,0 +1,121 @@
+import os
+import time
+import queue
+import logging
+import threading
+import concurrent.futures
+
+import pymongo
+
+logger = logging.getLogger(__name__)
+
+# votes are written in batches by a background thread, instead of one insert per request
+VOTES_WRITE_BEHIND = os.getenv('VOTES_WRITE_BEHIND', '0') == '1'
+
+# votes written at once, and milliseconds a batch waits to be filled
+VOTES_BATCH_SIZE = int(os.getenv('VOTES_BATCH_SIZE', '100'))
+VOTES_BATCH_INTERVAL = float(os.getenv('VOTES_BATCH_INTERVAL', '5'))
+
+# raised by mongo on a duplicated key, i.e. the client already voted the survey
+DUPLICATE_KEY = 11000
+
+#####
+# Write-behind of the votes. Requests submit their vote and wait on a future,
+# while a single thread takes whatever is queued (up to `batch_size` votes,
+# waiting at most `interval` milliseconds for more), inserts it with one
+# unordered insert_many and counts the accepted votes on the tallies. The
+# future is resolved once the batch is acknowledged: True if the vote was
+# recorded, False if the client had already voted; a vote failing on its own
+# raises its WriteError.
+class VoteWriter(object):
+    def __init__(self, db, batch_size: int = VOTES_BATCH_SIZE, interval: float = VOTES_BATCH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.interval = interval / 1000
+        self.queue = queue.Queue()
+
+        self.batches = 0
+        self.written = 0
+
+    def submit(self, vote: dict) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self.queue.put((vote, future))
+
+        return future
+
+    # blocks for the first vote, then takes the ones arriving until the batch is full or the interval is over
+    def next_batch(self) -> list[tuple]:
+        batch = [self.queue.get()]
+        deadline = time.monotonic() + self.interval
+
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+
+            try:
+                batch.append(self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait())
+
+            except queue.Empty:
+                break
+
+        return batch
+
+    def write(self, batch: list[tuple]):
+        votes = [vote for vote, _ in batch]
+        duplicated = set()
+        failed = {}
+
+        try:
+            self.db.votes_collection.insert_many(votes, ordered=False)
+
+        # the insert is unordered, every vote without an error of its own was recorded
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details.get('writeErrors', []):
+                if error['code'] == DUPLICATE_KEY:
+                    duplicated.add(error['index'])
+
+                else:
+                    failed[error['index']] = pymongo.errors.WriteError(error.get('errmsg'), error['code'], error)
+
+        accepted = [vote for i, vote in enumerate(votes) if i not in duplicated and i not in failed]
+
+        if accepted:
+            self.db.count_votes(accepted)
+
+        self.batches += 1
+        self.written += len(accepted)
+
+        if failed:
+            logger.error('[votes] {0} votes of a batch of {1} failed'.format(len(failed), len(batch)))
+
+        for i, (_, future) in enumerate(batch):
+            if i in failed:
+                future.set_exception(failed[i])
+
+            else:
+                future.set_result(i not in duplicated)
+
+    def run(self):
+        logger.info('[votes] writing behind, batches of {0} votes'.format(self.batch_size))
+
+        while True:
+            batch = self.next_batch()
+
+            try:
+                self.write(batch)
+
+            except Exception as e:
+                logger.exception('[votes] batch of {0} votes failed'.format(len(batch)))
+
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+
+    def start(self):
+        threading.Thread(target=self.run, name='vote-writer', daemon=True).start()
+
+    def stats(self) -> dict:
+        return {
+            'queued': self.queue.qsize(),
+            'batches': self.batches,
+            'written': self.written,
+        }